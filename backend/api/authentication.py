@@ -0,0 +1,120 @@
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.authentication import TokenAuthentication
+
+from recipes.versions import get_version, versions_are_shared
+
+VERSION_NAME = 'auth:{}'
+CACHE_KEY = 'auth:token:{}:{}'
+
+
+def token_cache_key(key):
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def token_version_name(key):
+    """Метка одного токена: известна до чтения из базы, а токен у
+    пользователя один, поэтому это и метка пользователя."""
+    return VERSION_NAME.format(token_cache_key(key))
+
+
+class TokenCache:
+    """LRU с ограниченным временем жизни: ключ токена → (пользователь,
+    токен) в памяти воркера.
+
+    Запись действительна, пока не истёк TTL и не сменилась метка
+    версии токена, которую сбрасывают его удаление и изменение его
+    пользователя. Если задан TOKEN_CACHE_ALIAS, промахи сначала ищутся
+    в кэше Django, общем для воркеров.
+
+    Метка должна быть общей для всех процессов, иначе выход из системы
+    в одном воркере не отзовёт токен в остальных, поэтому с локальным
+    кэшем меток (см. versions_are_shared) кэш токенов не используется.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def shared_cache(self):
+        alias = settings.TOKEN_CACHE_ALIAS
+        return caches[alias] if alias else None
+
+    def get(self, key, version):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, entry_version, snapshot = entry
+                if expires > now and entry_version == version:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return snapshot
+                del self.entries[key]
+        shared = self.shared_cache()
+        if shared is not None:
+            snapshot = shared.get(CACHE_KEY.format(version, key))
+            if snapshot is not None:
+                self.store(key, snapshot, version)
+                with self.lock:
+                    self.hits += 1
+                return snapshot
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, snapshot, version):
+        self.store(key, snapshot, version)
+        shared = self.shared_cache()
+        if shared is not None:
+            shared.set(CACHE_KEY.format(version, key), snapshot,
+                       timeout=settings.TOKEN_CACHE_TTL)
+
+    def store(self, key, snapshot, version):
+        with self.lock:
+            self.entries[key] = (
+                time.monotonic() + settings.TOKEN_CACHE_TTL, version,
+                snapshot)
+            self.entries.move_to_end(key)
+            while len(self.entries) > settings.TOKEN_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self.entries)}
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication без запроса к базе для уже известных токенов."""
+
+    def authenticate_credentials(self, key):
+        if not versions_are_shared():
+            return super().authenticate_credentials(key)
+        cache_key = token_cache_key(key)
+        # метка берётся до чтения из базы, чтобы изменение, случившееся
+        # во время чтения, не закрепило в кэше устаревшую запись
+        version = get_version(VERSION_NAME.format(cache_key))
+        snapshot = token_cache.get(cache_key, version)
+        if snapshot is not None:
+            user, token = map(copy.copy, snapshot)
+            token.user = user
+            return user, token
+        user, token = super().authenticate_credentials(key)
+        token_cache.set(cache_key, (user, token), version)
+        return user, token
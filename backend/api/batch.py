@@ -0,0 +1,140 @@
+"""Пакетные изменения избранного, корзины и подписок.
+
+bulk_create не вызывает сигналы, а delete() у queryset вызывает их
+для каждой строки, поэтому счётчики, сводная корзина и ленты
+обновляются здесь сразу для всего пакета.
+"""
+from django.db import connection, transaction
+from django.db.models import F
+
+from recipes.models import (Favorite, FeedEntry, Recipe, ShoppingCart,
+                            ShoppingCartIngredient)
+from users.models import Subscribe, User
+
+ADDED = 'added'
+EXISTS = 'exists'
+REMOVED = 'removed'
+ABSENT = 'absent'
+NOT_FOUND = 'not_found'
+SELF = 'self'
+
+RECIPE_COUNTERS = {
+    Favorite: 'favorites_count',
+    ShoppingCart: 'in_carts_count',
+}
+
+
+def lock_users(*pks):
+    """Блокирует строки пользователей до конца транзакции, всегда
+    по возрастанию id.
+
+    Изменения одного пользователя, пакетные и одиночные, выполняются
+    по очереди, иначе пакет разойдётся со снимком linked и посчитает
+    добавленным рецепт, который успел добавить другой запрос. Подписка
+    меняет и счётчик автора, поэтому блокируется и его строка: при
+    встречных подписках A на B и B на A обе транзакции берут строки
+    в одном порядке и не блокируют друг друга.
+    """
+    users = User.objects.filter(pk__in=pks)
+    if connection.features.has_select_for_update:
+        list(users.select_for_update().order_by('pk').values_list(
+            'pk', flat=True))
+    else:
+        # SQLite: пустой UPDATE сразу берёт блокировку записи, а чтение
+        # взяло бы разделяемую, и два запроса не смогли бы её повысить
+        users.update(id=F('id'))
+
+
+def shift_counters(model, field, added, removed):
+    """+1 добавленным и -1 убранным через F(), как в одиночных
+    сигналах: пересчёт по COUNT затёр бы приращения, которые другие
+    пользователи зафиксировали в это же время."""
+    if added:
+        model.objects.filter(pk__in=added).update(**{field: F(field) + 1})
+    if removed:
+        model.objects.filter(pk__in=removed, **{f'{field}__gt': 0}).update(
+            **{field: F(field) - 1})
+
+
+def delete_rows(queryset):
+    """Один DELETE без сигналов на каждую строку."""
+    return queryset._raw_delete(queryset.db)
+
+
+def outcomes(add, remove, added, removed, found, skipped=()):
+    """Исход по каждому id в порядке запроса."""
+    results = []
+    for pk in add:
+        if pk in skipped:
+            status = SELF
+        elif pk in added:
+            status = ADDED
+        elif pk in found:
+            status = EXISTS
+        else:
+            status = NOT_FOUND
+        results.append({'id': pk, 'status': status})
+    results += [{'id': pk, 'status': REMOVED if pk in removed else ABSENT}
+                for pk in remove]
+    return results
+
+
+@transaction.atomic
+def change_recipes(model, user, add=(), remove=()):
+    """Добавляет рецепты в избранное или корзину и убирает их оттуда."""
+    add, remove = list(dict.fromkeys(add)), list(dict.fromkeys(remove))
+    lock_users(user.pk)
+    linked = set(model.objects.filter(
+        user=user, recipe_id__in=add + remove
+    ).values_list('recipe_id', flat=True))
+    found = linked | set(Recipe.objects.filter(
+        pk__in=[pk for pk in add if pk not in linked]
+    ).values_list('pk', flat=True))
+    added = [pk for pk in add if pk in found and pk not in linked]
+    removed = [pk for pk in remove if pk in linked]
+    if added:
+        model.objects.bulk_create(
+            [model(user=user, recipe_id=pk) for pk in added],
+            ignore_conflicts=True)
+    if removed:
+        delete_rows(model.objects.filter(user=user, recipe_id__in=removed))
+    shift_counters(Recipe, RECIPE_COUNTERS[model], added, removed)
+    if model is ShoppingCart:
+        ShoppingCartIngredient.objects.change_recipes(
+            user.pk, added, removed)
+    return outcomes(add, remove, set(added), set(removed), found)
+
+
+def clear_recipes(model, user):
+    """Убирает все рецепты из избранного или корзины."""
+    return change_recipes(model, user, remove=model.objects.filter(
+        user=user).order_by('recipe_id').values_list('recipe_id', flat=True))
+
+
+@transaction.atomic
+def change_subscriptions(user, add=(), remove=()):
+    """Подписывает на авторов и отписывает от них."""
+    add, remove = list(dict.fromkeys(add)), list(dict.fromkeys(remove))
+    lock_users(user.pk, *add, *remove)
+    linked = set(Subscribe.objects.filter(
+        user=user, author_id__in=add + remove
+    ).values_list('author_id', flat=True))
+    found = linked | set(User.objects.filter(
+        pk__in=[pk for pk in add if pk not in linked and pk != user.pk]
+    ).values_list('pk', flat=True))
+    added = [pk for pk in add if pk in found and pk not in linked]
+    removed = [pk for pk in remove if pk in linked]
+    if added:
+        Subscribe.objects.bulk_create(
+            [Subscribe(user=user, author_id=pk) for pk in added],
+            ignore_conflicts=True)
+    if removed:
+        delete_rows(Subscribe.objects.filter(
+            user=user, author_id__in=removed))
+    shift_counters(User, 'subscribers_count', added, removed)
+    if added:
+        FeedEntry.objects.follow(user.pk, added)
+    if removed:
+        FeedEntry.objects.unfollow(user.pk, removed)
+    return outcomes(add, remove, set(added), set(removed), found,
+                    skipped={user.pk})
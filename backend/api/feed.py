@@ -0,0 +1,65 @@
+import base64
+import heapq
+from datetime import datetime
+from itertools import islice
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+
+from recipes.models import FeedEntry, Recipe
+
+
+def encode_cursor(pub_date, pk):
+    value = f'{pub_date.isoformat()}|{pk}'
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        pub_date, pk = base64.urlsafe_b64decode(
+            cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(pub_date), int(pk)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValidationError({'cursor': 'неверный курсор'})
+
+
+def feed_sources(user, size, cursor=None):
+    """Запросы, из которых собирается страница ленты.
+
+    Рецепты авторов, которые раскладываются по лентам при записи,
+    читаются из FeedEntry по индексу (user, pub_date); рецепты авторов
+    с FEED_FANOUT_LIMIT подписчиков и больше — через соединение
+    с подписками. Обе выборки упорядочены по (pub_date, id) и
+    ограничены размером страницы.
+    """
+    limit = settings.FEED_FANOUT_LIMIT
+    pulled = Recipe.objects.filter(
+        author__subscribing__user=user, author__subscribers_count__gte=limit)
+    pushed = FeedEntry.objects.filter(
+        user=user, author__subscribers_count__lt=limit)
+    if cursor is not None:
+        pub_date, pk = cursor
+        pulled = pulled.filter(
+            Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, pk__lt=pk))
+        pushed = pushed.filter(
+            Q(pub_date__lt=pub_date)
+            | Q(pub_date=pub_date, recipe_id__lt=pk))
+    sources = [pulled.order_by('-pub_date', '-id').values_list(
+        'pub_date', 'id')[:size + 1]]
+    if limit > 0:
+        sources.append(pushed.order_by(
+            '-pub_date', '-recipe_id').values_list(
+                'pub_date', 'recipe_id')[:size + 1])
+    return sources
+
+
+def feed_page(user, size, cursor=None):
+    """Страница ленты: id рецептов от новых к старым и курсор следующей
+    страницы или None."""
+    rows = list(islice(heapq.merge(
+        *feed_sources(user, size, cursor), reverse=True), size + 1))
+    next_cursor = None
+    if len(rows) > size:
+        next_cursor = encode_cursor(*rows[size - 1])
+    return [pk for _, pk in rows[:size]], next_cursor
@@ -1,13 +1,45 @@
+import threading
+
 from django_filters import rest_framework as filters
-from recipes.models import Ingredient, Recipe, Tag
+from recipes.models import Ingredient, Recipe, Tag, tags_mask
+from recipes.versions import get_version
+
+from .search import search_recipes
+
+
+class TagBits:
+    """Соответствие slug тега номеру его бита в Recipe.tags_mask.
+
+    Хранится в памяти воркера и перечитывается, когда меняется версия
+    тегов, поэтому фильтр по тегам не обращается к таблице тегов.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._bits = {}
+
+    def get(self):
+        version = get_version('tags')
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    self._bits = dict(
+                        Tag.objects.values_list('slug', 'bit'))
+                    self._version = version
+        return self._bits
+
+
+tag_bits = TagBits()
+
+
+def tag_choices():
+    return [(slug, slug) for slug in tag_bits.get()]
 
 
 class RecipeFilter(filters.FilterSet):
-    tags = filters.filters.ModelMultipleChoiceFilter(
-        queryset=Tag.objects.all(),
-        field_name='tags__slug',
-        to_field_name='slug',
-    )
+    tags = filters.MultipleChoiceFilter(
+        choices=tag_choices, method='filter_tags')
     author = filters.CharFilter(lookup_expr='exact')
     is_in_shopping_cart = filters.BooleanFilter(
         field_name='is_in_shopping_cart', method='filter'
@@ -15,6 +47,7 @@ class RecipeFilter(filters.FilterSet):
     is_favorited = filters.BooleanFilter(
         field_name='is_favorited', method='filter'
     )
+    search = filters.CharFilter(method='filter_search')
 
     def filter(self, queryset, name, value):
         if name == 'is_in_shopping_cart' and value:
@@ -27,9 +60,18 @@ class RecipeFilter(filters.FilterSet):
             )
         return queryset
 
+    def filter_tags(self, queryset, name, value):
+        bits = tag_bits.get()
+        return queryset.with_any_tag(
+            tags_mask(bits[slug] for slug in value if slug in bits))
+
+    def filter_search(self, queryset, name, value):
+        return search_recipes(queryset, value)
+
     class Meta:
         model = Recipe
-        fields = ('author', 'tags', 'is_in_shopping_cart', 'is_favorited',)
+        fields = ('author', 'tags', 'is_in_shopping_cart', 'is_favorited',
+                  'search')
 
 
 class IngredientsFilter(filters.FilterSet):
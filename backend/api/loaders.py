@@ -0,0 +1,104 @@
+from django.db import models
+from rest_framework import serializers
+
+from recipes.models import Favorite, ShoppingCart
+from users.models import Subscribe
+
+RELATIONS = {
+    'subscribed': (Subscribe, 'author_id'),
+    'favorited': (Favorite, 'recipe_id'),
+    'in_cart': (ShoppingCart, 'recipe_id'),
+}
+
+
+class RelationLoader:
+    """Отношения текущего пользователя к авторам и рецептам в рамках
+    одного запроса.
+
+    Для каждого вида отношения id загружаются пачкой одним запросом
+    и больше не запрашиваются; значения, уже посчитанные аннотацией
+    в queryset, запоминаются без обращения к базе.
+    """
+
+    def __init__(self, user):
+        self.user = user if user and user.is_authenticated else None
+        self.known = {kind: {} for kind in RELATIONS}
+
+    @classmethod
+    def for_request(cls, request):
+        if request is None:
+            return cls(None)
+        loader = getattr(request, '_relation_loader', None)
+        if loader is None or loader.user != (
+                request.user if request.user.is_authenticated else None):
+            loader = request._relation_loader = cls(request.user)
+        return loader
+
+    def remember(self, kind, pk, value):
+        self.known[kind][pk] = bool(value)
+
+    def load(self, kind, ids):
+        known = self.known[kind]
+        missing = {pk for pk in ids if pk not in known}
+        if not missing:
+            return
+        if self.user is None:
+            known.update(dict.fromkeys(missing, False))
+            return
+        model, field = RELATIONS[kind]
+        found = set(model.objects.filter(
+            user=self.user, **{f'{field}__in': missing}
+        ).values_list(field, flat=True))
+        known.update({pk: pk in found for pk in missing})
+
+    def has(self, kind, pk):
+        if pk not in self.known[kind]:
+            self.load(kind, [pk])
+        return self.known[kind][pk]
+
+
+class RelationListSerializer(serializers.ListSerializer):
+    """Перед сериализацией страницы загружает отношения для всех её
+    объектов сразу."""
+
+    def to_representation(self, data):
+        items = list(data.all() if isinstance(data, models.Manager)
+                     else data)
+        self.child.load_relations(items)
+        return super().to_representation(items)
+
+
+class RelationsMixin:
+    """Флаги is_subscribed, is_favorited и т.п. через RelationLoader.
+
+    relation_fields: (вид отношения, имя аннотации, внешний ключ или
+    None, если отношение относится к самому объекту).
+    """
+    relation_fields = ()
+
+    @property
+    def relations(self):
+        return RelationLoader.for_request(self.context.get('request'))
+
+    def load_relations(self, items):
+        relations = self.relations
+        for kind, attr, field in self.relation_fields:
+            pending = []
+            for item in items:
+                if field is None:
+                    pk, source = item.pk, item
+                else:
+                    pk = getattr(item, f'{field}_id')
+                    source = (getattr(item, field)
+                              if item._meta.get_field(field).is_cached(item)
+                              else None)
+                if hasattr(source, attr):
+                    relations.remember(kind, pk, getattr(source, attr))
+                else:
+                    pending.append(pk)
+            relations.load(kind, pending)
+
+    def relation(self, kind, attr, obj):
+        if hasattr(obj, attr):
+            return getattr(obj, attr)
+        return self.relations.has(kind, obj.pk)
@@ -0,0 +1,57 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.filters import IngredientsFilter
+from api.search import ingredient_index
+from recipes.models import Ingredient
+
+
+class Command(BaseCommand):
+    help = ('сравнивает поиск ингредиентов по префиксу через ORM '
+            'и через индекс в памяти')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def measure(self, func, prefixes):
+        timings = []
+        for prefix in prefixes:
+            started = time.perf_counter()
+            func(prefix)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        return (statistics.mean(timings),
+                timings[int(len(timings) * 0.95) - 1])
+
+    def handle(self, *args, **options):
+        names = list(Ingredient.objects.values_list('name', flat=True))
+        if not names:
+            raise CommandError('каталог ингредиентов пуст')
+        rnd = random.Random(options['seed'])
+        prefixes = []
+        for _ in range(options['iterations']):
+            name = rnd.choice(names)
+            prefixes.append(name[:rnd.randint(1, min(len(name), 5))])
+
+        def orm_search(prefix):
+            filterset = IngredientsFilter(
+                {'name': prefix}, queryset=Ingredient.objects.all())
+            return list(filterset.qs.values(
+                'id', 'name', 'measurement_unit'))
+
+        for prefix in prefixes[:50]:
+            if ({row['id'] for row in orm_search(prefix)}
+                    != {row['id']
+                        for row in ingredient_index.search(prefix)}):
+                self.stderr.write(
+                    f'результаты расходятся для префикса "{prefix}"')
+
+        for label, func in (('orm', orm_search),
+                            ('index', ingredient_index.search)):
+            mean, p95 = self.measure(func, prefixes)
+            self.stdout.write(
+                f'{label:>6}: среднее {mean:.3f} мс, p95 {p95:.3f} мс')
@@ -0,0 +1,144 @@
+import base64
+import io
+import random
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from api.feed import feed_sources
+from recipes.models import FeedEntry, Ingredient, Tag
+from users.models import Subscribe, User
+
+from .run_benchmarks import PERCENTILES, benchmark_database, measure
+
+# FEED_FANOUT_LIMIT, при котором раскладки при записи нет совсем
+PUSH_EVERYTHING = 2 ** 31 - 1
+
+
+class Command(BaseCommand):
+    help = ('сравнивает стоимость ленты подписок при чтении через '
+            'подписки, при раскладке по лентам при записи и в смешанном '
+            'режиме на синтетических данных во временной базе SQLite')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--recipes', type=int, default=5000)
+        parser.add_argument(
+            '--follow', type=int, default=100,
+            help='на сколько авторов подписан читатель ленты')
+        parser.add_argument(
+            '--hybrid-limit', type=int,
+            help='FEED_FANOUT_LIMIT для смешанного режима; по умолчанию '
+                 'через подписки читается 1%% самых популярных авторов')
+        parser.add_argument('--pages', type=int, default=20)
+        parser.add_argument('--iterations', type=int, default=30)
+        parser.add_argument('--warmup', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--explain', action='store_true',
+            help='показать планы запросов ленты')
+
+    def prepare(self, options):
+        call_command(
+            'seed_fake_data', users=options['users'],
+            recipes=options['recipes'], seed=options['seed'],
+            stdout=io.StringIO())
+        authors = list(User.objects.order_by(
+            '-subscribers_count', 'pk').values_list('pk', flat=True))
+        reader = User.objects.order_by('pk').last()
+        Subscribe.objects.bulk_create([
+            Subscribe(user=reader, author_id=author)
+            for author in authors[:options['follow']] if author != reader.pk
+        ], ignore_conflicts=True)
+        call_command('reconcile_counters', stdout=io.StringIO())
+        hybrid = options['hybrid_limit']
+        if hybrid is None:
+            hybrid = User.objects.order_by('-subscribers_count').values_list(
+                'subscribers_count', flat=True)[max(1, len(authors) // 100)]
+        return reader, User.objects.get(pk=authors[0]), hybrid
+
+    def client(self, user):
+        client = APIClient()
+        token, _ = Token.objects.get_or_create(user=user)
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        return client
+
+    def deep_page(self, client, pages):
+        url = '/api/recipes/feed/'
+        for _ in range(pages):
+            following = client.get(url).json()['next']
+            if following is None:
+                break
+            url = following
+        return url
+
+    def explain(self, reader):
+        for queryset in feed_sources(reader, settings.FEED_PAGE_SIZE):
+            sql, params = queryset.query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+                plan = [row[-1] for row in cursor.fetchall()]
+            self.stdout.write(
+                f'    {queryset.model._meta.model_name}: '
+                + '; '.join(plan))
+
+    def report(self, strategy, scenario, result):
+        self.stdout.write(
+            f'{strategy:>7} {scenario:>14}: ' + ', '.join(
+                f'p{rank} {result[f"p{rank}"]:.2f} мс'
+                for rank in PERCENTILES)
+            + f', запросов {result["queries"]}')
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            reader, star, hybrid = self.prepare(options)
+            self.stdout.write(
+                f'читатель подписан на '
+                f'{Subscribe.objects.filter(user=reader).count()} авторов, '
+                f'у самого популярного автора {star.subscribers_count} '
+                f'подписчиков, смешанный режим: FEED_FANOUT_LIMIT = {hybrid}')
+            reader_client, star_client = (
+                self.client(reader), self.client(star))
+            tag = Tag.objects.values_list('pk', flat=True).first()
+            ingredients = list(Ingredient.objects.values_list(
+                'pk', flat=True))
+            buffer = io.BytesIO()
+            Image.new('RGB', (64, 64), 'green').save(buffer, 'PNG')
+            image = ('data:image/png;base64,'
+                     + base64.b64encode(buffer.getvalue()).decode())
+            rnd = random.Random(options['seed'])
+
+            def publish():
+                return star_client.post('/api/recipes/', {
+                    'name': 'лента', 'text': 'текст', 'cooking_time': 10,
+                    'image': image, 'tags': [tag],
+                    'ingredients': [{'id': pk, 'amount': 10}
+                                    for pk in rnd.sample(ingredients, 5)],
+                }, format='json')
+
+            for strategy, limit in (('pull', 0), ('hybrid', hybrid),
+                                    ('push', PUSH_EVERYTHING)):
+                with override_settings(FEED_FANOUT_LIMIT=limit):
+                    call_command('rebuild_feed', stdout=io.StringIO())
+                    self.stdout.write(
+                        f'{strategy}: записей в лентах '
+                        f'{FeedEntry.objects.count()}')
+                    if options['explain']:
+                        self.explain(reader)
+                    deep = self.deep_page(reader_client, options['pages'])
+                    for scenario, request in (
+                        ('first_page', lambda: reader_client.get(
+                            '/api/recipes/feed/')),
+                        (f'page_{options["pages"]}',
+                         lambda: reader_client.get(deep)),
+                        ('publish', publish),
+                    ):
+                        self.report(strategy, scenario, measure(
+                            request, options['iterations'],
+                            options['warmup']))
@@ -0,0 +1,258 @@
+import base64
+import io
+import itertools
+import json
+import math
+import os
+import random
+import tempfile
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (CaptureQueriesContext, override_settings,
+                               setup_test_environment,
+                               teardown_test_environment)
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from recipes.models import Ingredient, Recipe, Tag
+from users.models import User
+
+# в репозитории хранится только число запросов: задержки зависят от
+# машины и сравниваются с эталоном, сохранённым на ней же
+DEFAULT_BASELINE = os.path.join(
+    settings.BASE_DIR, 'benchmarks', 'baseline.json')
+DEFAULT_LATENCY_BASELINE = os.path.join(
+    settings.BASE_DIR, 'benchmarks', 'latency.local.json')
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values, rank):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(len(ordered) * rank / 100) - 1)]
+
+
+def consume(response):
+    if response.streaming:
+        return b''.join(response.streaming_content)
+    return response.content
+
+
+def measure(request, iterations, warmup):
+    timings, queries = [], []
+    for number in range(warmup + iterations):
+        with CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            response = request()
+            consume(response)
+            elapsed = (time.perf_counter() - started) * 1000
+        if response.status_code >= 400:
+            raise CommandError(
+                f'ответ {response.status_code}: {response.content[:200]}')
+        if number >= warmup:
+            timings.append(elapsed)
+            queries.append(len(context.captured_queries))
+    result = {f'p{rank}': round(percentile(timings, rank), 3)
+              for rank in PERCENTILES}
+    result['queries'] = max(queries)
+    return result
+
+
+@contextmanager
+def benchmark_database():
+    """Временная тестовая база SQLite и каталог медиа на время замеров."""
+    if connection.vendor != 'sqlite':
+        raise CommandError(
+            'бенчмарки рассчитаны на SQLite: запустите с '
+            'DB_ENGINE=django.db.backends.sqlite3')
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(
+        verbosity=0, autoclobber=True, serialize=False)
+    try:
+        # замеры идут в одном процессе, кэш токенов безопасен
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=media_root, METRICS_DIR=None,
+                                  SINGLE_PROCESS=True):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def load_json(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def save_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, indent=2, sort_keys=True)
+        file.write('\n')
+    return path
+
+
+class Command(BaseCommand):
+    help = ('прогоняет основные эндпоинты через тестовый клиент на '
+            'синтетических данных во временной базе SQLite и сравнивает '
+            'число запросов с эталоном из репозитория, а задержки — '
+            'с локальным эталоном этой машины, если он сохранён')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--recipes', type=int, default=1000)
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+        parser.add_argument('--latency-baseline',
+                            default=DEFAULT_LATENCY_BASELINE)
+        parser.add_argument(
+            '--save-baseline', action='store_true',
+            help='записать число запросов и задержки как новые эталоны')
+        parser.add_argument(
+            '--save-latency', action='store_true',
+            help='записать только локальный эталон задержек')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.5,
+            help='допустимый рост p95 относительно эталона (0.5 = 50%%)')
+
+    def scenarios(self, rnd):
+        user = User.objects.order_by('-subscribers_count').first()
+        reader = User.objects.exclude(pk=user.pk).filter(
+            shopping_cart__isnull=False,
+            subscriber__isnull=False).distinct().first() or user
+        client = APIClient()
+        token = Token.objects.create(user=reader)
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        recipes = list(Recipe.objects.values_list('pk', flat=True))
+        tags = list(Tag.objects.values_list('slug', flat=True))
+        tag = Tag.objects.values_list('pk', flat=True).first()
+        names = list(Ingredient.objects.values_list('name', flat=True))
+        ingredients = list(Ingredient.objects.values_list('pk', flat=True))
+        buffer = io.BytesIO()
+        Image.new('RGB', (64, 64), 'green').save(buffer, 'PNG')
+        image = ('data:image/png;base64,'
+                 + base64.b64encode(buffer.getvalue()).decode())
+
+        planned = rnd.sample(recipes, 20)
+        cart_batches = itertools.cycle(
+            ({'add': planned}, {'remove': planned}))
+
+        def create_recipe():
+            return client.post('/api/recipes/', {
+                'name': 'бенчмарк', 'text': 'текст', 'cooking_time': 10,
+                'image': image, 'tags': [tag],
+                'ingredients': [{'id': pk, 'amount': 10}
+                                for pk in rnd.sample(ingredients, 5)],
+            }, format='json')
+
+        return {
+            'recipe_list': lambda: client.get(
+                f'/api/recipes/?page={rnd.randint(1, 5)}'),
+            'recipe_list_filtered': lambda: client.get(
+                '/api/recipes/?is_favorited=1&tags='
+                + '&tags='.join(rnd.sample(tags, 2))),
+            'recipe_detail': lambda: client.get(
+                f'/api/recipes/{rnd.choice(recipes)}/'),
+            'subscriptions': lambda: client.get(
+                '/api/users/subscriptions/?recipes_limit=3'),
+            'feed': lambda: client.get('/api/recipes/feed/'),
+            'ingredient_search': lambda: client.get(
+                '/api/ingredients/?name='
+                + rnd.choice(names)[:rnd.randint(1, 4)]),
+            'ingredient_fulltext': lambda: client.get(
+                '/api/ingredients/?search='
+                + rnd.choice(names)[1:rnd.randint(4, 7)]),
+            'recipes_by_ingredients': lambda: client.get(
+                '/api/recipes/by_ingredients/?ingredients='
+                + ','.join(map(str, rnd.sample(ingredients, 5)))),
+            'shopping_list': lambda: client.get(
+                '/api/recipes/download_shopping_cart/'),
+            'shopping_cart_batch': lambda: client.post(
+                '/api/recipes/shopping_cart/batch/', next(cart_batches),
+                format='json'),
+            'recipe_create': create_recipe,
+        }
+
+    def compare_queries(self, results, baseline):
+        return [
+            f'{name}: запросов {result["queries"]}, '
+            f'в эталоне {baseline[name]["queries"]}'
+            for name, result in results.items()
+            if name in baseline
+            and result['queries'] > baseline[name]['queries']
+        ]
+
+    def compare_latency(self, results, baseline, tolerance):
+        regressions = []
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            limit = baseline[name]['p95'] * (1 + tolerance) + 1
+            if result['p95'] > limit:
+                regressions.append(
+                    f'{name}: p95 {result["p95"]:.1f} мс, '
+                    f'допустимо {limit:.1f} мс')
+        return regressions
+
+    def run(self, options):
+        call_command(
+            'seed_fake_data', users=options['users'],
+            recipes=options['recipes'], seed=options['seed'],
+            stdout=self.stdout)
+        rnd = random.Random(options['seed'])
+        results = {}
+        for name, request in self.scenarios(rnd).items():
+            results[name] = measure(
+                request, options['iterations'], options['warmup'])
+            self.stdout.write(
+                f'{name:>22}: ' + ', '.join(
+                    f'p{rank} {results[name][f"p{rank}"]:.2f} мс'
+                    for rank in PERCENTILES)
+                + f', запросов {results[name]["queries"]}')
+        return results
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            results = self.run(options)
+
+        queries = {name: {'queries': result['queries']}
+                   for name, result in results.items()}
+        latency = {name: {key: value for key, value in result.items()
+                          if key != 'queries'}
+                   for name, result in results.items()}
+        saved = []
+        if options['save_baseline']:
+            saved.append(save_json(options['baseline'], queries))
+        if options['save_baseline'] or options['save_latency']:
+            saved.append(save_json(options['latency_baseline'], latency))
+        if saved:
+            self.stdout.write(self.style.SUCCESS(
+                'эталон записан в ' + ', '.join(saved)))
+            return
+        regressions = []
+        baseline = load_json(options['baseline'])
+        if baseline is None:
+            self.stdout.write('эталона запросов нет, сравнение пропущено')
+        else:
+            regressions += self.compare_queries(results, baseline)
+        baseline = load_json(options['latency_baseline'])
+        if baseline is None:
+            self.stdout.write(
+                'локального эталона задержек нет, они не сравниваются; '
+                'сохраните его с --save-latency')
+        else:
+            regressions += self.compare_latency(
+                results, baseline, options['tolerance'])
+        if regressions:
+            raise CommandError(
+                'регрессия относительно эталона:\n' + '\n'.join(regressions))
+        self.stdout.write(self.style.SUCCESS('регрессий нет'))
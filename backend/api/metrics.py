@@ -0,0 +1,167 @@
+import glob
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+
+HISTOGRAMS = {
+    'duration': (
+        'foodgram_http_request_duration_seconds',
+        'время обработки запроса',
+        (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    ),
+    'queries': (
+        'foodgram_sql_queries',
+        'число SQL-запросов на запрос',
+        (1, 2, 5, 10, 20, 50, 100, 200),
+    ),
+    'sql_duration': (
+        'foodgram_sql_duration_seconds',
+        'время SQL на запрос',
+        (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+    ),
+    'size': (
+        'foodgram_http_response_size_bytes',
+        'размер тела ответа',
+        (100, 1000, 10000, 100000, 1000000, 10000000),
+    ),
+}
+REQUESTS_TOTAL = 'foodgram_http_requests_total'
+
+
+def empty_histogram(name):
+    return {'buckets': [0] * len(HISTOGRAMS[name][2]), 'sum': 0, 'count': 0}
+
+
+class MetricsRegistry:
+    """Счётчики по маршрутам в памяти процесса.
+
+    Если задан METRICS_DIR, каждый процесс периодически записывает свои
+    накопленные значения в отдельный файл, а выдача суммирует файлы всех
+    процессов — так числа сходятся при нескольких воркерах gunicorn.
+    Значения накопительные, поэтому файлы завершившихся воркеров
+    остаются в сумме, как у счётчиков Prometheus.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.statuses = {}
+        self.flushed_at = 0
+
+    def observe(self, name, key, value):
+        with self.lock:
+            histogram = self.routes.setdefault(key, {}).setdefault(
+                name, empty_histogram(name))
+            for index, bound in enumerate(HISTOGRAMS[name][2]):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def record(self, route, method, status, duration, queries,
+               sql_duration, size=None):
+        key = f'{route}|{method}'
+        self.observe('duration', key, duration)
+        self.observe('queries', key, queries)
+        self.observe('sql_duration', key, sql_duration)
+        if size is not None:
+            self.observe('size', key, size)
+        with self.lock:
+            status_key = f'{key}|{status}'
+            self.statuses[status_key] = self.statuses.get(status_key, 0) + 1
+        self.maybe_flush()
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(
+                {'routes': self.routes, 'statuses': self.statuses}))
+
+    def path(self):
+        return os.path.join(
+            settings.METRICS_DIR, f'metrics_{os.getpid()}.json')
+
+    def maybe_flush(self, force=False):
+        if not settings.METRICS_DIR:
+            return
+        now = time.monotonic()
+        interval = settings.METRICS_FLUSH_INTERVAL
+        if not force and now - self.flushed_at < interval:
+            return
+        self.flushed_at = now
+        path = self.path()
+        temporary = f'{path}.{threading.get_ident()}.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(self.snapshot(), file)
+        os.replace(temporary, path)
+
+    def collect(self):
+        """Суммарные значения по всем процессам."""
+        if not settings.METRICS_DIR:
+            return self.snapshot()
+        self.maybe_flush(force=True)
+        total = {'routes': {}, 'statuses': {}}
+        pattern = os.path.join(settings.METRICS_DIR, 'metrics_*.json')
+        for path in glob.glob(pattern):
+            try:
+                with open(path) as file:
+                    data = json.load(file)
+            except (OSError, ValueError):
+                continue
+            for key, histograms in data['routes'].items():
+                route = total['routes'].setdefault(key, {})
+                for name, histogram in histograms.items():
+                    merged = route.setdefault(name, empty_histogram(name))
+                    merged['buckets'] = [
+                        a + b for a, b
+                        in zip(merged['buckets'], histogram['buckets'])]
+                    merged['sum'] += histogram['sum']
+                    merged['count'] += histogram['count']
+            for key, count in data['statuses'].items():
+                total['statuses'][key] = (
+                    total['statuses'].get(key, 0) + count)
+        return total
+
+
+def escape(value):
+    return (value.replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def labels(key, *names):
+    return ','.join(
+        f'{name}="{escape(value)}"'
+        for name, value in zip(names, key.split('|')))
+
+
+def render_prometheus(data):
+    lines = [
+        f'# HELP {REQUESTS_TOTAL} число запросов',
+        f'# TYPE {REQUESTS_TOTAL} counter',
+    ]
+    for key, count in sorted(data['statuses'].items()):
+        lines.append(
+            f'{REQUESTS_TOTAL}{{{labels(key, "route", "method", "status")}}}'
+            f' {count}')
+    for name, (metric, description, bounds) in HISTOGRAMS.items():
+        lines += [f'# HELP {metric} {description}',
+                  f'# TYPE {metric} histogram']
+        for key, histograms in sorted(data['routes'].items()):
+            histogram = histograms.get(name)
+            if histogram is None:
+                continue
+            route = labels(key, 'route', 'method')
+            for bound, count in zip(bounds, histogram['buckets']):
+                lines.append(
+                    f'{metric}_bucket{{{route},le="{bound}"}} {count}')
+            lines += [
+                f'{metric}_bucket{{{route},le="+Inf"}} {histogram["count"]}',
+                f'{metric}_sum{{{route}}} {histogram["sum"]}',
+                f'{metric}_count{{{route}}} {histogram["count"]}',
+            ]
+    return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
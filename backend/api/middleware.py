@@ -0,0 +1,84 @@
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.db import connections
+
+from .metrics import registry
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - started
+
+
+@contextmanager
+def counting(counter):
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(counter))
+        yield
+
+
+class StreamedContent:
+    """Тело потокового ответа: запросы, выполненные при выдаче частей,
+    попадают в счётчик, а метрики записываются при закрытии ответа,
+    когда известны полное время и размер."""
+
+    def __init__(self, content, counter, finish):
+        self.content = content
+        self.counter = counter
+        self.finish = finish
+        self.size = 0
+        self.closed = False
+
+    def __iter__(self):
+        iterator = iter(self.content)
+        while True:
+            with counting(self.counter):
+                chunk = next(iterator, None)
+            if chunk is None:
+                return
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.finish(self.size)
+
+
+class MetricsMiddleware:
+    """Время ответа, число и время SQL-запросов и размер ответа
+    по имени маршрута; у потоковых ответов — вместе с выдачей тела."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        counter = QueryCounter()
+        started = time.perf_counter()
+        with counting(counter):
+            response = self.get_response(request)
+        match = request.resolver_match
+        route = match.view_name if match else '<unmatched>'
+
+        def finish(size):
+            registry.record(route, request.method, response.status_code,
+                            time.perf_counter() - started, counter.count,
+                            counter.duration, size)
+
+        if response.streaming:
+            response.streaming_content = StreamedContent(
+                response.streaming_content, counter, finish)
+        else:
+            finish(len(response.content))
+        return response
@@ -0,0 +1,48 @@
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+
+class ConditionalGetMixin:
+    """ETag и Last-Modified по дешёвой метке версии.
+
+    get_version_stamp() возвращает пару (etag, время изменения или None)
+    без сериализации данных; при совпадении If-None-Match или
+    If-Modified-Since ответ 304 отдаётся без вызова сериализатора.
+    """
+    conditional_actions = ('list', 'retrieve')
+    cache_control = {'private': True, 'no_cache': True}
+
+    def get_version_stamp(self, request):
+        return None
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        stamp = getattr(self, '_version_stamp', None)
+        if stamp is not None and response.status_code in (200, 304):
+            etag, last_modified = stamp
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+            patch_cache_control(response, **self.cache_control)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+    def conditional_response(self, request):
+        if (self.action not in self.conditional_actions
+                or hasattr(self, '_version_stamp')):
+            return None
+        self._version_stamp = self.get_version_stamp(request)
+        if self._version_stamp is None:
+            return None
+        etag, last_modified = self._version_stamp
+        return get_conditional_response(
+            request, etag=etag,
+            last_modified=(int(last_modified)
+                           if last_modified is not None else None)
+        )
+
+    def list(self, request, *args, **kwargs):
+        return (self.conditional_response(request)
+                or super().list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return (self.conditional_response(request)
+                or super().retrieve(request, *args, **kwargs))
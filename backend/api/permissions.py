@@ -8,3 +8,8 @@ class IsAuthorOrAdmin(permissions.BasePermission):
                or obj.author == request.user):
                 return True
         return request.method in permissions.SAFE_METHODS
+
+
+class IsAdmin(permissions.BasePermission):
+    def has_permission(self, request, view):
+        return request.user.is_authenticated and request.user.is_admin
@@ -0,0 +1,438 @@
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import (Case, F, FloatField, IntegerField, Q, Value,
+                              When)
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Upper
+from django.utils import timezone
+
+from recipes.models import (SEARCH_CONFIG, Ingredient, IngredientAmount,
+                            Recipe)
+from recipes.versions import get_version
+
+SIMILARITY_THRESHOLD = 0.3
+FUZZY_CANDIDATES = 50
+SYNC_BATCH_SIZE = 1000
+# битовое множество занимает (наибольший id) / 8 байт, а массив — 4 байта
+# на рецепт, но массив на каждый запрос превращается в биты; битами
+# хранятся ингредиенты, которые есть больше чем в каждом 256-м рецепте
+DENSE_RATIO = 256
+
+
+class IngredientIndex:
+    """Отсортированный индекс ингредиентов для поиска по префиксу.
+
+    Строится лениво в каждом воркере и перестраивается, когда меняется
+    версия каталога ингредиентов.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._data = ([], [])
+
+    def _build(self):
+        rows = sorted(
+            Ingredient.objects.values('id', 'name', 'measurement_unit'),
+            key=lambda row: (row['name'].casefold(), row['id'])
+        )
+        self._data = ([row['name'].casefold() for row in rows], rows)
+
+    def _ensure_fresh(self):
+        version = get_version('ingredients')
+        if version == self._version:
+            return
+        with self._lock:
+            if version != self._version:
+                self._build()
+                self._version = version
+
+    def search(self, prefix, limit=None):
+        self._ensure_fresh()
+        keys, rows = self._data
+        key = prefix.casefold()
+        start = bisect_left(keys, key)
+        end = bisect_left(keys, key + '\U0010ffff', lo=start)
+        if limit is not None:
+            end = min(end, start + limit)
+        return rows[start:end]
+
+
+ingredient_index = IngredientIndex()
+
+
+def trigrams(value):
+    """Множество триграмм строки по правилам pg_trgm."""
+    result = set()
+    for word in value.casefold().split():
+        padded = f'  {word} '
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def similarity(first, second):
+    first, second = trigrams(first), trigrams(second)
+    if not first or not second:
+        return 0
+    return len(first & second) / len(first | second)
+
+
+def _search_postgresql(query, limit):
+    from django.contrib.postgres.search import TrigramSimilarity
+
+    query = query.upper()
+    return list(Ingredient.objects.annotate(
+        upper_name=Upper('name'),
+    ).filter(
+        Q(upper_name__contains=query) | Q(upper_name__trigram_similar=query)
+    ).annotate(
+        rank=Case(
+            When(upper_name__startswith=query, then=Value(0)),
+            When(upper_name__contains=query, then=Value(1)),
+            default=Value(2),
+            output_field=IntegerField(),
+        ),
+        similarity=TrigramSimilarity('upper_name', query),
+    ).order_by('rank', '-similarity', 'name').values(
+        'id', 'name', 'measurement_unit')[:limit])
+
+
+def _fts_match(expression, limit):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT rowid FROM recipes_ingredient_fts '
+            'WHERE recipes_ingredient_fts MATCH %s '
+            'ORDER BY bm25(recipes_ingredient_fts) LIMIT %s',
+            [expression, limit]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _fts_phrase(value):
+    return '"{}"'.format(value.replace('"', '""'))
+
+
+def _search_sqlite(query, limit):
+    results = list(ingredient_index.search(query, limit))
+    key = query.casefold()
+    if len(results) >= limit or len(key) < 3:
+        return results
+    seen = {row['id'] for row in results}
+
+    substring_ids = _fts_match(_fts_phrase(key), limit)
+    fuzzy_ids = _fts_match(
+        ' OR '.join(_fts_phrase(key[i:i + 3]) for i in range(len(key) - 2)),
+        FUZZY_CANDIDATES
+    )
+    rows = Ingredient.objects.in_bulk(substring_ids + fuzzy_ids)
+    substring, fuzzy = [], []
+    for ingredient in rows.values():
+        if ingredient.id in seen:
+            continue
+        row = {'id': ingredient.id, 'name': ingredient.name,
+               'measurement_unit': ingredient.measurement_unit}
+        if key in ingredient.name.casefold():
+            substring.append(row)
+            continue
+        score = similarity(query, ingredient.name)
+        if score >= SIMILARITY_THRESHOLD:
+            fuzzy.append((score, row))
+    substring.sort(key=lambda row: row['name'].casefold())
+    fuzzy.sort(key=lambda item: (-item[0], item[1]['name'].casefold()))
+    results.extend(substring)
+    results.extend(row for _, row in fuzzy)
+    return results[:limit]
+
+
+def search_ingredients(query, limit):
+    """Поиск ингредиентов: сначала совпадения по началу названия,
+    затем по подстроке, затем нечёткие совпадения."""
+    if connection.vendor == 'postgresql':
+        return _search_postgresql(query, limit)
+    if connection.vendor == 'sqlite':
+        return _search_sqlite(query, limit)
+    return list(Ingredient.objects.filter(name__icontains=query).values(
+        'id', 'name', 'measurement_unit')[:limit])
+
+
+RECIPE_FTS_MATCH = (
+    'SELECT rowid FROM recipes_recipe_fts WHERE recipes_recipe_fts MATCH %s')
+# bm25 меньше у лучших совпадений; название весит в 10 раз больше текста
+RECIPE_FTS_RANK = (
+    'SELECT -bm25(recipes_recipe_fts, 10.0, 1.0) FROM recipes_recipe_fts '
+    'WHERE recipes_recipe_fts MATCH %s AND rowid = recipes_recipe.id')
+
+
+def search_recipes(queryset, query):
+    """Полнотекстовый поиск по названию и тексту рецепта, от лучших
+    совпадений к худшим. Название весит больше текста."""
+    if connection.vendor == 'postgresql':
+        from django.contrib.postgres.search import SearchQuery, SearchRank
+
+        query = SearchQuery(
+            query, config=SEARCH_CONFIG, search_type='websearch')
+        return queryset.filter(search_vector=query).annotate(
+            search_rank=SearchRank(F('search_vector'), query)
+        ).order_by('-search_rank', '-pub_date', '-id')
+    words = re.findall(r'\w+', query.casefold())
+    if not words:
+        return queryset.none()
+    expression = ' '.join(f'{_fts_phrase(word)}*' for word in words)
+    return queryset.filter(
+        pk__in=RawSQL(RECIPE_FTS_MATCH, [expression])
+    ).annotate(
+        search_rank=RawSQL(RECIPE_FTS_RANK, [expression],
+                           output_field=FloatField())
+    ).order_by('-search_rank', '-pub_date', '-id')
+
+
+try:
+    popcount = int.bit_count
+except AttributeError:  # Python < 3.10
+    def popcount(value):
+        return bin(value).count('1')
+
+
+def bitset(ids):
+    """Множество неотрицательных чисел в виде битов целого числа."""
+    if not ids:
+        return 0
+    bits = bytearray((max(ids) >> 3) + 1)
+    for pk in ids:
+        bits[pk >> 3] |= 1 << (pk & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def drop_highest(value, count):
+    """Сбрасывает count старших единичных битов."""
+    if not count:
+        return value
+    low, high = 0, value.bit_length()
+    while low < high:
+        middle = (low + high) // 2
+        if popcount(value >> middle) <= count:
+            high = middle
+        else:
+            low = middle + 1
+    return value & ((1 << low) - 1)
+
+
+class RankedRecipes:
+    """Рецепты-кандидаты, упорядоченные по доле имеющихся ингредиентов.
+
+    groups — пары битовых множеств (рецепты с m совпадениями, рецепты
+    из n ингредиентов) в порядке убывания m / n, затем m; внутри группы
+    рецепты идут от новых к старым. Поддерживает len() и срезы, поэтому
+    подходит для пагинатора; id извлекаются только для запрошенного
+    среза.
+    """
+
+    def __init__(self, total, groups):
+        self.total = total
+        self.groups = groups
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start, stop, _ = index.indices(self.total)
+        result, skip, need = [], start, stop - start
+        for matched, size in self.groups:
+            if need <= 0:
+                break
+            group = matched & size
+            if not group:
+                continue
+            count = popcount(group)
+            if skip >= count:
+                skip -= count
+                continue
+            group, skip = drop_highest(group, skip), 0
+            while group and need:
+                pk = group.bit_length() - 1
+                result.append(pk)
+                group ^= 1 << pk
+                need -= 1
+        return result
+
+
+class RecipeIngredientIndex:
+    """Обратный индекс «ингредиент → рецепты» для подбора рецептов
+    по имеющимся продуктам.
+
+    Рецепты частых ингредиентов и рецепты каждого размера хранятся
+    битовыми множествами по id, поэтому подсчёт совпадений и разбиение
+    на группы по доле — несколько операций над целыми числами, а не
+    цикл по рецептам. Редкие ингредиенты хранятся массивами id и
+    превращаются в биты только на время запроса. При 300 тыс. рецептов
+    и 2000 ингредиентов индекс занимает около 55 МБ в каждом воркере,
+    в основном списки ингредиентов рецептов; одни битовые множества
+    всех ингредиентов заняли бы около 85 МБ.
+
+    Строится лениво в каждом воркере. Изменённые рецепты находятся по
+    updated_at с запасом RECIPE_INDEX_SYNC_OVERLAP на долгие транзакции,
+    ингредиенты дочитываются только у ещё не виденных пар (id,
+    updated_at), удалённые отбрасываются при смене версии
+    'deleted_recipes', а при изменении каталога ингредиентов индекс
+    строится заново.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = {}
+        self._sizes = {}
+        self._recipes = {}
+        self._limit = 0
+        self._synced_at = None
+        self._versions = None
+        self._recent = set()
+
+    def _posting(self, ids):
+        if len(ids) * DENSE_RATIO > self._limit:
+            return bitset(ids)
+        return array('I', ids)
+
+    def _add(self, ingredient, recipe_id):
+        posting = self._postings.get(ingredient, array('I'))
+        if isinstance(posting, int):
+            posting |= 1 << recipe_id
+        else:
+            posting.append(recipe_id)
+            posting = self._posting(posting)
+        self._postings[ingredient] = posting
+
+    def _discard(self, ingredient, recipe_id):
+        posting = self._postings[ingredient]
+        if isinstance(posting, int):
+            posting &= ~(1 << recipe_id)
+        else:
+            posting.remove(recipe_id)
+        if posting:
+            self._postings[ingredient] = posting
+        else:
+            del self._postings[ingredient]
+
+    def _bits(self, ingredient):
+        posting = self._postings.get(ingredient, 0)
+        return posting if isinstance(posting, int) else bitset(posting)
+
+    @staticmethod
+    def _remove(sets, key, bit):
+        value = sets[key] & ~bit
+        if value:
+            sets[key] = value
+        else:
+            del sets[key]
+
+    def _set(self, recipe_id, ingredients):
+        old = set(self._recipes.get(recipe_id, ()))
+        if old == set(ingredients):
+            return
+        self._limit = max(self._limit, recipe_id + 1)
+        for ingredient in old - set(ingredients):
+            self._discard(ingredient, recipe_id)
+        for ingredient in set(ingredients) - old:
+            self._add(ingredient, recipe_id)
+        bit = 1 << recipe_id
+        if old:
+            self._remove(self._sizes, len(old), bit)
+        if ingredients:
+            self._sizes[len(ingredients)] = (
+                self._sizes.get(len(ingredients), 0) | bit)
+            self._recipes[recipe_id] = array('I', ingredients)
+        else:
+            del self._recipes[recipe_id]
+
+    def _load(self, **filters):
+        ingredients = {}
+        for recipe_id, ingredient_id in IngredientAmount.objects.filter(
+                **filters).values_list('recipe_id', 'ingredient_id'):
+            ingredients.setdefault(recipe_id, set()).add(ingredient_id)
+        return {recipe_id: array('I', values)
+                for recipe_id, values in ingredients.items()}
+
+    def _rebuild(self):
+        recipes = self._load()
+        postings, sizes = {}, {}
+        for recipe_id, ingredients in recipes.items():
+            for ingredient in ingredients:
+                postings.setdefault(ingredient, []).append(recipe_id)
+            sizes.setdefault(len(ingredients), []).append(recipe_id)
+        self._limit = max(recipes, default=-1) + 1
+        self._postings = {key: self._posting(ids)
+                          for key, ids in postings.items()}
+        self._sizes = {key: bitset(ids) for key, ids in sizes.items()}
+        self._recipes = recipes
+
+    def _sync(self):
+        started = timezone.now()
+        versions = (get_version('ingredients'),
+                    get_version('deleted_recipes'))
+        if self._synced_at is None or versions[0] != self._versions[0]:
+            self._rebuild()
+            self._recent = set()
+        else:
+            overlap = timedelta(seconds=settings.RECIPE_INDEX_SYNC_OVERLAP)
+            recent = set(Recipe.objects.filter(
+                updated_at__gte=self._synced_at - overlap
+            ).order_by().values_list('pk', 'updated_at'))
+            changed = sorted({pk for pk, _ in recent - self._recent})
+            for start in range(0, len(changed), SYNC_BATCH_SIZE):
+                for recipe_id, ingredients in self._load(recipe_id__in=changed[
+                        start:start + SYNC_BATCH_SIZE]).items():
+                    self._set(recipe_id, ingredients)
+            self._recent = recent
+            if versions[1] != self._versions[1]:
+                existing = set(Recipe.objects.values_list('pk', flat=True))
+                for recipe_id in self._recipes.keys() - existing:
+                    self._set(recipe_id, ())
+        self._synced_at = started
+        self._versions = versions
+
+    def rank(self, ingredients):
+        """Рецепты, в которых есть хотя бы один из ингредиентов, от
+        большей доли имеющихся ингредиентов к меньшей; при равенстве
+        выше рецепт, где совпало больше, затем более новый."""
+        ingredients = set(ingredients)
+        with self._lock:
+            self._sync()
+            # число совпадений у каждого рецепта — в двоичных разрядах
+            # planes: бит рецепта в planes[i] равен i-му разряду счётчика
+            planes = []
+            for ingredient in ingredients:
+                carry = self._bits(ingredient)
+                for number, plane in enumerate(planes):
+                    if not carry:
+                        break
+                    planes[number], carry = plane ^ carry, plane & carry
+                if carry:
+                    planes.append(carry)
+            sizes = dict(self._sizes)
+        matched = 0
+        for plane in planes:
+            matched |= plane
+        exactly = {}
+        for count in range(1, len(ingredients) + 1):
+            value = matched
+            for number, plane in enumerate(planes):
+                value &= plane if count >> number & 1 else ~plane
+            if value:
+                exactly[count] = value
+        pairs = sorted(
+            ((count, size) for count in exactly for size in sizes
+             if count <= size),
+            key=lambda pair: (pair[0] / pair[1], pair[0]), reverse=True)
+        return RankedRecipes(
+            popcount(matched),
+            [(exactly[count], sizes[size]) for count, size in pairs])
+
+
+recipe_ingredient_index = RecipeIngredientIndex()
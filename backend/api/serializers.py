@@ -1,17 +1,24 @@
-from drf_extra_fields.fields import Base64ImageField
+from drf_extra_fields.fields import Base64FieldMixin, Base64ImageField
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.shortcuts import get_object_or_404
+from django.core.files.uploadedfile import UploadedFile
+from django.db import transaction
 from djoser.serializers import UserCreateSerializer, UserSerializer
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from rest_framework.fields import IntegerField
 from rest_framework.serializers import ModelSerializer
 
+from recipes.images import derivative_srcset
 from recipes.models import (Favorite, Ingredient, IngredientAmount, Recipe,
-                            Tag, ShoppingCart)
+                            RecipeTag, Tag, ShoppingCart,
+                            ShoppingCartIngredient, tags_mask)
 from users.models import Subscribe
 
+from .loaders import RelationListSerializer, RelationsMixin
+from .uploads import UploadTooLarge, check_image_header
+from .utils import get_recipes_limit
+
 User = get_user_model()
 
 
@@ -23,11 +30,13 @@ class UserRegistrationSerializer(UserCreateSerializer):
                   'password')
 
 
-class CustomUserSerializer(UserSerializer):
+class CustomUserSerializer(RelationsMixin, UserSerializer):
     is_subscribed = serializers.SerializerMethodField(read_only=True)
+    relation_fields = (('subscribed', 'is_subscribed', None),)
 
     class Meta:
         model = User
+        list_serializer_class = RelationListSerializer
         fields = ('email', 'id', 'username', 'first_name', 'last_name',
                   'is_subscribed', 'password')
         extra_kwargs = {'password': {'write_only': True, 'required': True}}
@@ -42,10 +51,7 @@ class CustomUserSerializer(UserSerializer):
         return user
 
     def get_is_subscribed(self, obj):
-        user = self.context.get('request').user
-        if not user or user.is_anonymous:
-            return False
-        return Subscribe.objects.filter(user=user, author=obj).exists()
+        return self.relation('subscribed', 'is_subscribed', obj)
 
 
 class SubscribeUserSerializer(serializers.ModelSerializer):
@@ -72,47 +78,81 @@ class SubscribeUserSerializer(serializers.ModelSerializer):
         return data
 
 
+class ImageSrcsetField(serializers.Field):
+    """Набор уменьшенных копий изображения для атрибута srcset."""
+
+    def __init__(self, **kwargs):
+        kwargs['source'] = 'image'
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, image):
+        if not image:
+            return None
+        request = self.context.get('request')
+        return derivative_srcset(
+            image, request.build_absolute_uri if request else None)
+
+
+class RecipeImageField(Base64ImageField):
+    """Изображение строкой base64 или файлом из multipart/form-data."""
+    ALLOWED_TYPES = Base64ImageField.ALLOWED_TYPES + ('webp',)
+
+    def to_internal_value(self, data):
+        if isinstance(data, str):
+            if len(data) > settings.RECIPE_IMAGE_MAX_SIZE * 4 // 3 + 100:
+                raise UploadTooLarge()
+            data = super().to_internal_value(data)
+            check_image_header(data)
+            return data
+        if isinstance(data, UploadedFile):
+            check_image_header(data)
+            return super(Base64FieldMixin, self).to_internal_value(data)
+        return super().to_internal_value(data)
+
+
 class SubscribingRecipesSerializers(serializers.ModelSerializer):
+    image_srcset = ImageSrcsetField()
+
     class Meta:
         model = Recipe
-        fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'image_srcset', 'cooking_time')
 
 
-class SubscribeViewSerializer(serializers.ModelSerializer):
+class SubscribeViewSerializer(RelationsMixin, serializers.ModelSerializer):
     is_subscribed = serializers.SerializerMethodField()
     recipes = serializers.SerializerMethodField()
     recipes_count = serializers.SerializerMethodField()
+    relation_fields = (('subscribed', 'is_subscribed', None),)
 
     class Meta:
         model = User
+        list_serializer_class = RelationListSerializer
         fields = ('id', 'email', 'username', 'first_name', 'last_name',
                   'is_subscribed', 'recipes', 'recipes_count')
         read_only_fields = fields
 
     def get_is_subscribed(self, obj):
-        if not self.context.get('request').user.is_authenticated:
-            return False
-        return Subscribe.objects.filter(
-            author=obj, user=self.context['request'].user).exists()
+        return self.relation('subscribed', 'is_subscribed', obj)
 
     def get_recipes(self, obj):
-        recipes_limit = int(self.context['request'].GET.get(
-            'recipes_limit', settings.RECIPES_LIMIT))
-        user = get_object_or_404(User, pk=obj.pk)
-        recipes = Recipe.objects.filter(author=user)[:recipes_limit]
+        if hasattr(obj, 'limited_recipes'):
+            recipes = obj.limited_recipes
+        else:
+            recipes = obj.recipes.all()[
+                :get_recipes_limit(self.context['request'])]
 
         return SubscribingRecipesSerializers(recipes, many=True).data
 
     def get_recipes_count(self, obj):
-        user = get_object_or_404(User, pk=obj.pk)
-        return Recipe.objects.filter(author=user).count()
+        return obj.recipes_count
 
 
 class TagSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Tag
-        fields = '__all__'
+        fields = ('id', 'name', 'color', 'slug')
 
 
 class IngredientSerializer(serializers.ModelSerializer):
@@ -142,9 +182,13 @@ class RecipeIngredientSerializer(serializers.ModelSerializer):
 
 
 class AddRecipeIngredientsSerializer(serializers.ModelSerializer):
-    id = serializers.PrimaryKeyRelatedField(
-        queryset=Ingredient.objects.all(),
-        source='ingredient'
+    id = serializers.IntegerField()
+    amount = serializers.IntegerField(
+        min_value=1,
+        error_messages={
+            'invalid': 'количество должно быть числом',
+            'min_value': 'количество должно быть больше 0',
+        }
     )
 
     class Meta:
@@ -155,12 +199,9 @@ class AddRecipeIngredientsSerializer(serializers.ModelSerializer):
 class AddRecipeSerializer(serializers.ModelSerializer):
     author = CustomUserSerializer(read_only=True)
     ingredients = AddRecipeIngredientsSerializer(many=True)
-    tags = serializers.PrimaryKeyRelatedField(
-        queryset=Tag.objects.all(),
-        many=True
-    )
+    tags = serializers.ListField(child=serializers.IntegerField())
     cooking_time = serializers.IntegerField()
-    image = Base64ImageField(max_length=None, use_url=True)
+    image = RecipeImageField(max_length=None, use_url=True)
 
     class Meta:
         model = Recipe
@@ -168,25 +209,19 @@ class AddRecipeSerializer(serializers.ModelSerializer):
                   'image', 'text', 'cooking_time')
 
     def validate_ingredients(self, data):
-        ingredients = self.initial_data.get('ingredients')
-        if not ingredients:
+        if not data:
             raise serializers.ValidationError(
                 'нужно выбрать как минимум 1 ингредиент')
-        for ingredient in ingredients:
-            try:
-                int(ingredient.get('amount'))
-                if int(ingredient.get('amount')) <= 0:
-                    raise serializers.ValidationError(
-                        'количество должно быть больше 0')
-            except Exception:
-                raise ValidationError({'amount': 'количество должно'
-                                      'быть числом'})
-            check_id = ingredient['id']
-            check_ingredient = Ingredient.objects.filter(id=check_id)
-            if not check_ingredient.exists():
-                raise serializers.ValidationError(
-                    'данного продукта нет в базе')
-        return data
+        ids = [ingredient['id'] for ingredient in data]
+        if len(ids) != len(set(ids)):
+            raise serializers.ValidationError(
+                'ингредиенты не должны повторяться')
+        ingredients = Ingredient.objects.in_bulk(ids)
+        if len(ingredients) != len(ids):
+            raise serializers.ValidationError(
+                'данного продукта нет в базе')
+        return [{'ingredient': ingredients[ingredient['id']],
+                 'amount': ingredient['amount']} for ingredient in data]
 
     def validate_cooking_time(self, data):
         cooking_time = self.initial_data.get('cooking_time')
@@ -201,20 +236,19 @@ class AddRecipeSerializer(serializers.ModelSerializer):
         return data
 
     def validate_tags(self, data):
-        tags = self.initial_data.get('tags')
-        if not tags:
+        if not data:
             raise serializers.ValidationError(
                 'рецепт не может быть без тегов'
             )
-        for tag_id in tags:
-            if not Tag.objects.filter(id=tag_id).exists():
+        if len(data) != len(set(data)):
+            raise ValidationError('теги должны быть уникальными')
+        tags = Tag.objects.in_bulk(data)
+        for tag_id in data:
+            if tag_id not in tags:
                 raise serializers.ValidationError(
                     f'тега с id = {tag_id} не существует'
                 )
-        tags_bd = set(tags)
-        if len(tags) != len(tags_bd):
-            raise ValidationError('теги должны быть уникальными')
-        return data
+        return [tags[tag_id] for tag_id in data]
 
     def create_bulk(self, recipe, ingredients_data):
         IngredientAmount.objects.bulk_create([IngredientAmount(
@@ -223,35 +257,82 @@ class AddRecipeSerializer(serializers.ModelSerializer):
             amount=ingredient['amount']
         ) for ingredient in ingredients_data])
 
+    @transaction.atomic
     def create(self, validated_data):
         author = self.context.get('request').user
         tags_data = validated_data.pop('tags')
         ingredients_data = validated_data.pop('ingredients')
-        recipe = Recipe.objects.create(author=author, **validated_data)
-        recipe.save()
-        recipe.tags.set(tags_data)
+        recipe = Recipe.objects.create(
+            author=author, tags_mask=tags_mask(tag.bit for tag in tags_data),
+            **validated_data)
+        RecipeTag.objects.bulk_create(
+            RecipeTag(recipe=recipe, tag=tag) for tag in tags_data)
         self.create_bulk(recipe, ingredients_data)
         return recipe
 
+    @staticmethod
+    def is_same_image(current, uploaded):
+        """Имя файла в хранилище определяется содержимым, поэтому
+        сравниваются имена без чтения текущего файла."""
+        if not current:
+            return False
+        return current.name == current.storage.content_name(
+            current.field.generate_filename(current.instance, uploaded.name),
+            uploaded)
+
+    def update_ingredients(self, recipe, ingredients):
+        existing = {
+            amount.ingredient_id: amount
+            for amount in IngredientAmount.objects.filter(recipe=recipe)
+        }
+        old_amounts = {key: value.amount for key, value in existing.items()}
+        new_amounts = {item['ingredient'].id: item['amount']
+                       for item in ingredients}
+        to_create, to_update = [], []
+        for item in ingredients:
+            current = existing.get(item['ingredient'].id)
+            if current is None:
+                to_create.append(IngredientAmount(
+                    recipe=recipe, ingredient=item['ingredient'],
+                    amount=item['amount']))
+            elif current.amount != item['amount']:
+                current.amount = item['amount']
+                to_update.append(current)
+        to_delete = [value.pk for key, value in existing.items()
+                     if key not in new_amounts]
+        IngredientAmount.objects.bulk_create(to_create)
+        IngredientAmount.objects.bulk_update(to_update, ['amount'])
+        if to_delete:
+            IngredientAmount.objects.filter(pk__in=to_delete).delete()
+        ShoppingCartIngredient.objects.change_recipe(
+            recipe, old_amounts, new_amounts)
+
+    def update_tags(self, recipe, tags):
+        existing = set(RecipeTag.objects.filter(recipe=recipe).values_list(
+            'tag_id', flat=True))
+        new = {tag.id for tag in tags}
+        RecipeTag.objects.bulk_create(
+            RecipeTag(recipe=recipe, tag=tag)
+            for tag in tags if tag.id not in existing)
+        if existing - new:
+            RecipeTag.objects.filter(
+                recipe=recipe, tag_id__in=existing - new).delete()
+        recipe.tags_mask = tags_mask(tag.bit for tag in tags)
+
+    @transaction.atomic
     def update(self, recipe, validated_data):
         recipe.name = validated_data.get('name', recipe.name)
         recipe.text = validated_data.get('text', recipe.text)
         recipe.cooking_time = validated_data.get(
             'cooking_time', recipe.cooking_time
         )
-        recipe.image = validated_data.get('image', recipe.image)
-        if 'ingredients' in self.initial_data:
-            ingredients = validated_data.pop('ingredients')
-            recipe.ingredients.clear()
-            for ingredient in ingredients:
-                IngredientAmount.objects.create(
-                    recipe=recipe,
-                    ingredient=ingredient['ingredient'],
-                    amount=ingredient['amount'],
-                )
-        if 'tags' in self.initial_data:
-            tags_data = validated_data.pop('tags')
-            recipe.tags.set(tags_data)
+        image = validated_data.get('image')
+        if image and not self.is_same_image(recipe.image, image):
+            recipe.image = image
+        if 'ingredients' in validated_data:
+            self.update_ingredients(recipe, validated_data['ingredients'])
+        if 'tags' in validated_data:
+            self.update_tags(recipe, validated_data['tags'])
         recipe.save()
         return recipe
 
@@ -262,41 +343,66 @@ class AddRecipeSerializer(serializers.ModelSerializer):
         representation = super().to_representation(recipe)
         representation['ingredients'] = RecipeIngredientSerializer(
             IngredientAmount.objects.filter(
-                recipe=recipe).all(), many=True).data
+                recipe=recipe).select_related('ingredient'), many=True).data
 
         return representation
 
 
-class ShowRecipeFullSerializer(serializers.ModelSerializer):
+class ShowRecipeFullSerializer(RelationsMixin, serializers.ModelSerializer):
     tags = TagSerializer(many=True, read_only=True)
     author = CustomUserSerializer(read_only=True)
     ingredients = serializers.SerializerMethodField()
     is_favorited = serializers.SerializerMethodField()
     is_in_shopping_cart = serializers.SerializerMethodField()
+    image_srcset = ImageSrcsetField()
+    relation_fields = (
+        ('favorited', 'is_favorited', None),
+        ('in_cart', 'is_in_shopping_cart', None),
+        ('subscribed', 'is_subscribed', 'author'),
+    )
 
     class Meta:
         model = Recipe
+        list_serializer_class = RelationListSerializer
         fields = ('id', 'tags', 'author', 'ingredients', 'name',
-                  'image', 'text', 'cooking_time', 'is_favorited',
-                  'is_in_shopping_cart')
+                  'image', 'image_srcset', 'text', 'cooking_time',
+                  'is_favorited', 'is_in_shopping_cart')
 
     def get_ingredients(self, obj):
-        ingredients = IngredientAmount.objects.filter(recipe=obj)
+        ingredients = obj.ingredientamount_set.all()
         return RecipeIngredientSerializer(ingredients, many=True).data
 
     def get_is_favorited(self, obj):
-        request = self.context.get('request')
-        if request.user.is_anonymous:
-            return False
-        return Favorite.objects.filter(recipe=obj,
-                                       user=request.user).exists()
+        return self.relation('favorited', 'is_favorited', obj)
 
     def get_is_in_shopping_cart(self, obj):
-        request = self.context.get('request')
-        if request.user.is_anonymous:
-            return False
-        return ShoppingCart.objects.filter(recipe=obj,
-                                           user=request.user).exists()
+        return self.relation('in_cart', 'is_in_shopping_cart', obj)
+
+
+class RecipeCoverageSerializer(ShowRecipeFullSerializer):
+    """Рецепт с долей имеющихся ингредиентов и списком недостающих;
+    имеющиеся ингредиенты передаются в context['ingredients']."""
+    coverage = serializers.SerializerMethodField()
+    missing_ingredients = serializers.SerializerMethodField()
+
+    class Meta(ShowRecipeFullSerializer.Meta):
+        fields = ShowRecipeFullSerializer.Meta.fields + (
+            'coverage', 'missing_ingredients')
+
+    def get_coverage(self, obj):
+        amounts = obj.ingredientamount_set.all()
+        if not amounts:
+            return 0
+        available = self.context['ingredients']
+        found = sum(amount.ingredient_id in available for amount in amounts)
+        return round(found / len(amounts), 3)
+
+    def get_missing_ingredients(self, obj):
+        available = self.context['ingredients']
+        return IngredientSerializer([
+            amount.ingredient for amount in obj.ingredientamount_set.all()
+            if amount.ingredient_id not in available
+        ], many=True).data
 
 
 class FavoriteSerializer(serializers.ModelSerializer):
@@ -363,3 +469,22 @@ class IngredientAmountWriteSerializer(ModelSerializer):
     class Meta:
         model = IngredientAmount
         fields = ('id', 'amount')
+
+
+class BatchSerializer(serializers.Serializer):
+    """Списки id для пакетного добавления и удаления."""
+    add = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), default=list,
+        max_length=settings.BATCH_MAX_SIZE)
+    remove = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), default=list,
+        max_length=settings.BATCH_MAX_SIZE)
+
+    def validate(self, data):
+        if not data['add'] and not data['remove']:
+            raise serializers.ValidationError(
+                'укажите id для добавления или удаления')
+        if set(data['add']) & set(data['remove']):
+            raise serializers.ValidationError(
+                'один и тот же id нельзя добавить и удалить')
+        return data
@@ -0,0 +1,27 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from recipes.versions import bump_version
+
+from .authentication import token_version_name
+from .utils import AUTHOR_VERSION_NAME
+
+User = get_user_model()
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    bump_version(token_version_name(instance.key))
+
+
+@receiver((post_save, post_delete), sender=User)
+def user_changed(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    # сбрасываются только записи этого пользователя, а не весь кэш
+    bump_version(AUTHOR_VERSION_NAME.format(instance.pk))
+    for key in Token.objects.filter(user_id=instance.pk).values_list(
+            'key', flat=True):
+        bump_version(token_version_name(key))
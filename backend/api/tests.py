@@ -0,0 +1,730 @@
+import base64
+import io
+import logging
+import shutil
+import tempfile
+import threading
+from collections import Counter
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from api.authentication import token_cache
+from api.metrics import registry
+from api.search import recipe_ingredient_index
+from api.serializers import AddRecipeSerializer
+from api.utils import get_shopping_list_etag
+from recipes.images import derivative_names, open_scaled
+from recipes.models import (Favorite, FeedEntry, Ingredient,
+                            IngredientAmount, Recipe, RecipeTag, ShoppingCart,
+                            ShoppingCartIngredient, Tag)
+from users.models import Subscribe, User
+
+
+def image_bytes():
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), 'green').save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def image_file(name='recipe.png'):
+    return SimpleUploadedFile(name, image_bytes())
+
+
+class APITestMixin:
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        # тесты идут в одном процессе, как runserver
+        cls.media = override_settings(MEDIA_ROOT=cls.media_root,
+                                      SINGLE_PROCESS=True)
+        cls.media.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.media.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+    def setUp(self):
+        # версии справочников и кэш токенов живут в кэше, а база
+        # откатывается после каждого теста
+        cache.clear()
+
+    def client_for(self, user):
+        client = APIClient()
+        token = Token.objects.create(user=user)
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        return client
+
+
+class APITestCase(APITestMixin, TestCase):
+    pass
+
+
+class APITransactionTestCase(APITestMixin, TransactionTestCase):
+    """Для проверок с несколькими потоками: каждый поток работает
+    в своём соединении и видит только зафиксированные данные."""
+
+
+class RecipeListQueriesTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [
+            User.objects.create_user(
+                username=f'user{number}', email=f'user{number}@example.com',
+                password='password', first_name='Имя', last_name='Фамилия')
+            for number in range(4)
+        ]
+        tags = [Tag.objects.create(name=slug, slug=slug, color=color)
+                for slug, color in (('breakfast', '#E26C2D'),
+                                    ('lunch', '#49B64E'))]
+        ingredients = [
+            Ingredient.objects.create(name=f'продукт {number}',
+                                      measurement_unit='г')
+            for number in range(5)
+        ]
+        for number in range(30):
+            recipe = Recipe.objects.create(
+                author=cls.users[number % 4], name=f'рецепт {number}',
+                text='текст', cooking_time=10,
+                image=image_file())
+            RecipeTag.objects.create(recipe=recipe, tag=tags[number % 2])
+            for ingredient in ingredients[:number % 5 + 1]:
+                IngredientAmount.objects.create(
+                    recipe=recipe, ingredient=ingredient, amount=number + 1)
+            if number % 3 == 0:
+                Favorite.objects.create(user=cls.users[0], recipe=recipe)
+            if number % 4 == 0:
+                ShoppingCart.objects.create(user=cls.users[0], recipe=recipe)
+        Subscribe.objects.create(user=cls.users[0], author=cls.users[1])
+
+    def assert_page_queries(self, client, url, size, queries):
+        with self.assertNumQueries(queries):
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), size)
+
+    def test_page_query_count_does_not_depend_on_page_size(self):
+        client = self.client_for(self.users[0])
+        # токен проверяется один раз и дальше берётся из кэша
+        client.get('/api/recipes/')
+        # count, страница, авторы, теги, ингредиенты
+        self.assert_page_queries(client, '/api/recipes/', 6, 5)
+        self.assert_page_queries(client, '/api/recipes/?page=2', 6, 5)
+        # без count
+        self.assert_page_queries(
+            client, '/api/recipes/?pagination=cursor&limit=6', 6, 4)
+        self.assert_page_queries(
+            client, '/api/recipes/?pagination=cursor&limit=24', 24, 4)
+
+    def test_anonymous_page_query_count(self):
+        client = APIClient()
+        self.assert_page_queries(client, '/api/recipes/', 6, 5)
+        self.assert_page_queries(
+            client, '/api/recipes/?pagination=cursor&limit=6', 6, 4)
+        self.assert_page_queries(
+            client, '/api/recipes/?pagination=cursor&limit=24', 24, 4)
+
+
+class TagsTest(APITestCase):
+    def test_tag_bit_is_not_exposed(self):
+        Tag.objects.create(name='обед', slug='lunch', color='#49B64E')
+        response = APIClient().get('/api/tags/')
+        self.assertEqual(set(response.json()[0]),
+                         {'id', 'name', 'color', 'slug'})
+
+
+class IngredientSearchTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for name in ('сахар', 'коричневый сахар', 'соль', 'мука'):
+            Ingredient.objects.create(name=name, measurement_unit='г')
+
+    def search(self, query):
+        response = APIClient().get('/api/ingredients/', {'search': query})
+        self.assertEqual(response.status_code, 200)
+        return [ingredient['name'] for ingredient in response.json()]
+
+    def test_prefix_first_then_substring(self):
+        self.assertEqual(self.search('сахар'), ['сахар', 'коричневый сахар'])
+
+    def test_substring_and_typo(self):
+        self.assertIn('коричневый сахар', self.search('ахар'))
+        self.assertIn('сахар', self.search('сахр'))
+        self.assertEqual(self.search('коричневый'), ['коричневый сахар'])
+
+    def test_renamed_ingredient_is_found_by_new_name(self):
+        Ingredient.objects.filter(name='мука').update(name='мука ржаная')
+        self.assertEqual(self.search('ржаная'), ['мука ржаная'])
+
+
+class RecipeETagTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            username='author', email='author@example.com',
+            password='password', first_name='Анна', last_name='Иванова')
+        cls.recipe = Recipe.objects.create(
+            author=cls.author, name='суп', text='текст', cooking_time=10,
+            image=image_file())
+
+    def test_author_change_invalidates_etag(self):
+        client = APIClient()
+        url = f'/api/recipes/{self.recipe.pk}/'
+        etag = client.get(url)['ETag']
+        self.assertEqual(
+            client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.author.first_name = 'Мария'
+        self.author.save()
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['author']['first_name'], 'Мария')
+
+    def test_other_user_change_keeps_etag(self):
+        client = APIClient()
+        url = f'/api/recipes/{self.recipe.pk}/'
+        etag = client.get(url)['ETag']
+        User.objects.create_user(
+            username='reader', email='reader@example.com',
+            password='password')
+        self.assertEqual(
+            client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+class ShoppingListETagTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='buyer', email='buyer@example.com', password='password')
+        cls.ingredients = [
+            Ingredient.objects.create(name=f'продукт {number}',
+                                      measurement_unit='г')
+            for number in range(3)
+        ]
+
+    def etag_for(self, amounts):
+        ShoppingCartIngredient.objects.filter(user=self.user).delete()
+        ShoppingCartIngredient.objects.bulk_create(
+            ShoppingCartIngredient(user=self.user,
+                                   ingredient=self.ingredients[index],
+                                   amount=amount)
+            for index, amount in amounts.items())
+        return get_shopping_list_etag(self.user, 'txt')
+
+    def test_different_carts_with_equal_sums(self):
+        # одинаковые число строк, сумма и взвешенная сумма
+        self.assertNotEqual(self.etag_for({0: 3, 2: 1}),
+                            self.etag_for({0: 2, 1: 2}))
+
+    def test_ingredient_rename_changes_etag(self):
+        etag = self.etag_for({0: 1})
+        ingredient = self.ingredients[0]
+        ingredient.name = 'продукт новый'
+        ingredient.save()
+        self.assertNotEqual(get_shopping_list_etag(self.user, 'txt'), etag)
+
+
+class TokenCacheTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='reader', email='reader@example.com', password='password')
+
+    def setUp(self):
+        super().setUp()
+        token_cache.clear()
+
+    def test_cached_with_shared_versions(self):
+        client = self.client_for(self.user)
+        client.get('/api/users/me/')
+        # остаётся только проверка подписки на себя
+        with self.assertNumQueries(1):
+            client.get('/api/users/me/')
+
+    def test_invalidated_per_user(self):
+        client = self.client_for(self.user)
+        client.get('/api/users/me/')
+        other = User.objects.create_user(
+            username='other', email='other@example.com', password='password')
+        self.client_for(other)
+        other.first_name = 'Иван'
+        other.save()
+        with self.assertNumQueries(1):
+            client.get('/api/users/me/')
+        self.user.first_name = 'Пётр'
+        self.user.save()
+        with self.assertNumQueries(2):
+            response = client.get('/api/users/me/')
+        self.assertEqual(response.json()['first_name'], 'Пётр')
+
+    @override_settings(SINGLE_PROCESS=False)
+    def test_local_cache_is_not_used_across_processes(self):
+        # метки версий в LocMemCache не видны другим воркерам, и выход
+        # из системы не отозвал бы закэшированный токен
+        client = self.client_for(self.user)
+        client.get('/api/users/me/')
+        with self.assertNumQueries(2):
+            client.get('/api/users/me/')
+        self.assertEqual(token_cache.info()['size'], 0)
+
+
+class RecipeAdminCartTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(
+            username='admin', email='admin@example.com', password='password')
+        cls.buyer = User.objects.create_user(
+            username='buyer', email='buyer@example.com', password='password')
+        cls.tag = Tag.objects.create(name='обед', slug='lunch',
+                                     color='#49B64E')
+        cls.salt, cls.flour = [
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('соль', 'мука')
+        ]
+        cls.recipe = Recipe.objects.create(
+            author=cls.admin, name='хлеб', text='текст', cooking_time=60,
+            image=image_file())
+        RecipeTag.objects.create(recipe=cls.recipe, tag=cls.tag)
+        cls.amount = IngredientAmount.objects.create(
+            recipe=cls.recipe, ingredient=cls.salt, amount=5)
+        ShoppingCart.objects.create(user=cls.buyer, recipe=cls.recipe)
+
+    def test_inline_ingredients_update_cart(self):
+        self.client.force_login(self.admin)
+        recipe_tag = RecipeTag.objects.get(recipe=self.recipe)
+        response = self.client.post(
+            f'/admin/recipes/recipe/{self.recipe.pk}/change/', {
+                'name': 'хлеб', 'author': self.admin.pk, 'text': 'текст',
+                'cooking_time': 60, 'tags': [self.tag.pk],
+                'ingredientamount_set-TOTAL_FORMS': 2,
+                'ingredientamount_set-INITIAL_FORMS': 1,
+                'ingredientamount_set-0-id': self.amount.pk,
+                'ingredientamount_set-0-recipe': self.recipe.pk,
+                'ingredientamount_set-0-ingredient': self.salt.pk,
+                'ingredientamount_set-0-amount': 7,
+                'ingredientamount_set-1-recipe': self.recipe.pk,
+                'ingredientamount_set-1-ingredient': self.flour.pk,
+                'ingredientamount_set-1-amount': 500,
+                'recipe_tag-TOTAL_FORMS': 1,
+                'recipe_tag-INITIAL_FORMS': 1,
+                'recipe_tag-0-id': recipe_tag.pk,
+                'recipe_tag-0-recipe': self.recipe.pk,
+                'recipe_tag-0-tag': self.tag.pk,
+            })
+        self.assertEqual(response.status_code, 302, response.content)
+        self.assertEqual(
+            dict(ShoppingCartIngredient.objects.filter(
+                user=self.buyer).values_list('ingredient_id', 'amount')),
+            {self.salt.pk: 7, self.flour.pk: 500})
+
+
+class RecipeImageTest(APITestCase):
+    def test_scaled_by_oriented_width(self):
+        image = Image.new('RGB', (400, 100), 'green')
+        exif = image.getexif()
+        exif[0x0112] = 6
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', exif=exif.tobytes())
+        buffer.seek(0)
+        # повёрнутая картинка 100×400 уменьшается до ширины 50
+        self.assertEqual(open_scaled(buffer, 50).size, (50, 200))
+
+    def test_derivatives_created_after_commit(self):
+        author = User.objects.create_user(
+            username='cook', email='cook@example.com', password='password')
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe = Recipe.objects.create(
+                author=author, name='суп', text='текст', cooking_time=10,
+                image=image_file())
+            storage = recipe.image.storage
+            self.assertFalse(any(
+                storage.exists(name)
+                for _, _, name in derivative_names(recipe.image.name)))
+        self.assertTrue(all(
+            storage.exists(name)
+            for _, _, name in derivative_names(recipe.image.name)))
+
+    def test_reused_file_restored_after_orphan_cleanup(self):
+        author = User.objects.create_user(
+            username='cook', email='cook@example.com', password='password')
+        with self.captureOnCommitCallbacks(execute=True):
+            first = Recipe.objects.create(
+                author=author, name='суп', text='текст', cooking_time=10,
+                image=image_file())
+        storage, name = first.image.storage, first.image.name
+        with self.captureOnCommitCallbacks(execute=True):
+            second = Recipe.objects.create(
+                author=author, name='борщ', text='текст', cooking_time=10,
+                image=image_file())
+            self.assertEqual(second.image.name, name)
+            # другой запрос удалил первый рецепт и, не видя второго,
+            # удалил файл вместе с копиями
+            storage.delete(name)
+            for _, _, derivative in derivative_names(name):
+                storage.delete(derivative)
+        self.assertTrue(storage.exists(name))
+        with storage.open(name) as file:
+            self.assertEqual(file.read(), image_bytes())
+        self.assertTrue(all(storage.exists(derivative)
+                            for _, _, derivative in derivative_names(name)))
+
+
+class RecipesByIngredientsTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(
+            username='cook', email='cook@example.com', password='password')
+        cls.a, cls.b, cls.c = [
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('соль', 'мука', 'сахар')
+        ]
+        cls.recipes = []
+        for ingredients in ((cls.a, cls.b), (cls.a,), (cls.a, cls.b, cls.c)):
+            recipe = Recipe.objects.create(
+                author=author, name='рецепт', text='текст', cooking_time=10,
+                image=image_file())
+            for ingredient in ingredients:
+                IngredientAmount.objects.create(
+                    recipe=recipe, ingredient=ingredient, amount=1)
+            cls.recipes.append(recipe)
+
+    def ranked(self):
+        response = APIClient().get('/api/recipes/by_ingredients/', {
+            'ingredients': f'{self.a.pk},{self.b.pk}'})
+        self.assertEqual(response.status_code, 200)
+        return [recipe['id'] for recipe in response.json()['results']]
+
+    def check_ranking(self):
+        first, second, third = self.recipes
+        self.assertEqual(self.ranked(), [first.pk, second.pk, third.pk])
+        IngredientAmount.objects.filter(recipe=second).update(
+            ingredient=self.c)
+        second.save()
+        self.assertEqual(self.ranked(), [first.pk, third.pk])
+
+    def test_dense_postings(self):
+        self.check_ranking()
+
+    def test_sparse_postings(self):
+        # при единичном отношении все ингредиенты хранятся массивами
+        with mock.patch('api.search.DENSE_RATIO', 1):
+            self.check_ranking()
+
+
+class StreamedMetricsTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='buyer', email='buyer@example.com', password='password')
+        for number in range(3):
+            ShoppingCartIngredient.objects.create(
+                user=cls.user, amount=number + 1,
+                ingredient=Ingredient.objects.create(
+                    name=f'продукт {number}', measurement_unit='г'))
+
+    url = '/api/recipes/download_shopping_cart/'
+
+    def histograms(self):
+        return registry.snapshot()['routes'].get(
+            f'{resolve(self.url).view_name}|GET', {})
+
+    def test_streamed_body_is_measured(self):
+        client = self.client_for(self.user)
+        before = self.histograms()
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(self.url)
+            body = b''.join(response.streaming_content)
+        after = self.histograms()
+
+        def added(name):
+            return (after[name]['sum']
+                    - before.get(name, {'sum': 0})['sum'])
+
+        # основной запрос строк выполняется уже при выдаче тела
+        self.assertEqual(added('queries'), len(queries))
+        self.assertEqual(added('size'), len(body))
+        self.assertGreater(added('sql_duration'), 0)
+
+
+class SubscriptionsRecipesLimitTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader, author = [
+            User.objects.create_user(
+                username=name, email=f'{name}@example.com',
+                password='password')
+            for name in ('reader', 'author')
+        ]
+        for number in range(12):
+            Recipe.objects.create(
+                author=author, name=f'рецепт {number}', text='текст',
+                cooking_time=10, image=image_file())
+        Subscribe.objects.create(user=cls.reader, author=author)
+
+    def setUp(self):
+        super().setUp()
+        self.reader_client = self.client_for(self.reader)
+
+    def recipes(self, limit):
+        response = self.reader_client.get(
+            '/api/users/subscriptions/', {'recipes_limit': limit})
+        self.assertEqual(response.status_code, 200)
+        return len(response.json()['results'][0]['recipes'])
+
+    def test_recipes_limit(self):
+        self.assertEqual(self.recipes(3), 3)
+        self.assertEqual(self.recipes(0), 0)
+
+    def test_invalid_recipes_limit(self):
+        self.assertEqual(self.recipes('abc'), 10)
+        self.assertEqual(self.recipes(-1), 0)
+
+
+class RecipeCreateIndexTest(APITransactionTestCase):
+    def test_recipe_synced_during_create_is_indexed(self):
+        author = User.objects.create_user(
+            username='cook', email='cook@example.com', password='password')
+        tag = Tag.objects.create(name='обед', slug='lunch', color='#49B64E')
+        ingredient = Ingredient.objects.create(name='соль',
+                                               measurement_unit='г')
+        create_bulk = AddRecipeSerializer.create_bulk
+        errors = []
+
+        def sync_index():
+            try:
+                recipe_ingredient_index.rank({ingredient.pk})
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        def create_bulk_with_sync(serializer, recipe, ingredients):
+            # другой запрос обновляет индекс, пока рецепт создаётся
+            thread = threading.Thread(target=sync_index)
+            thread.start()
+            thread.join()
+            create_bulk(serializer, recipe, ingredients)
+
+        # индекс уже построен, дальше он только дочитывает изменения
+        recipe_ingredient_index.rank({ingredient.pk})
+        with mock.patch.object(AddRecipeSerializer, 'create_bulk',
+                               create_bulk_with_sync):
+            response = self.client_for(author).post('/api/recipes/', {
+                'name': 'суп', 'text': 'текст', 'cooking_time': 10,
+                'image': 'data:image/png;base64,'
+                         + base64.b64encode(image_bytes()).decode(),
+                'tags': [tag.pk],
+                'ingredients': [{'id': ingredient.pk, 'amount': 5}],
+            }, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(errors, [])
+        response = APIClient().get('/api/recipes/by_ingredients/',
+                                   {'ingredients': ingredient.pk})
+        self.assertEqual([recipe['id'] for recipe in
+                          response.json()['results']],
+                         [Recipe.objects.get().pk])
+
+
+class BatchCountersTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, cls.author = [
+            User.objects.create_user(
+                username=name, email=f'{name}@example.com',
+                password='password')
+            for name in ('reader', 'author')
+        ]
+        cls.recipe = Recipe.objects.create(
+            author=cls.author, name='суп', text='текст', cooking_time=10,
+            image=image_file())
+
+    def test_batch_shifts_counters_instead_of_recounting(self):
+        # приращения, которые другие пользователи зафиксировали в это
+        # же время, не должны затираться пересчётом
+        Recipe.objects.filter(pk=self.recipe.pk).update(favorites_count=10)
+        User.objects.filter(pk=self.author.pk).update(subscribers_count=10)
+        client = self.client_for(self.user)
+        for url, pk in (('/api/recipes/favorite/batch/', self.recipe.pk),
+                        ('/api/users/subscribe/batch/', self.author.pk)):
+            for key, expected in (('add', 11), ('remove', 10)):
+                response = client.post(url, {key: [pk]}, format='json')
+                self.assertEqual(response.status_code, 200)
+                self.recipe.refresh_from_db()
+                self.author.refresh_from_db()
+                self.assertEqual(
+                    self.recipe.favorites_count if 'recipes' in url
+                    else self.author.subscribers_count, expected)
+
+
+def create_toggle_data(test):
+    """Автор с рецептом из двух ингредиентов и читатель."""
+    test.user, test.author = [
+        User.objects.create_user(
+            username=name, email=f'{name}@example.com', password='password')
+        for name in ('reader', 'author')
+    ]
+    test.recipe = Recipe.objects.create(
+        author=test.author, name='суп', text='текст', cooking_time=10,
+        image=image_file())
+    for number in range(2):
+        IngredientAmount.objects.create(
+            recipe=test.recipe, amount=number + 1,
+            ingredient=Ingredient.objects.create(
+                name=f'продукт {number}', measurement_unit='г'))
+
+
+class ToggleQueriesTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_toggle_data(cls)
+
+    def statements(self, client, method, url):
+        """Запросы к данным без BEGIN и точек сохранения: их число
+        зависит от того, во что завёрнут тест, а не от обработчика."""
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(client, method)(url)
+        return response.status_code, len([
+            query for query in context.captured_queries
+            if not query['sql'].startswith(
+                ('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT'))
+        ])
+
+    def test_toggle_query_count(self):
+        client = self.client_for(self.user)
+        client.get('/api/users/me/')
+        recipe, author = self.recipe.pk, self.author.pk
+        for url, added, removed in (
+                # рецепт, блокировка, INSERT, счётчик
+                (f'/api/recipes/{recipe}/favorite/', 4, 3),
+                # и сводная корзина: ингредиенты рецепта, её строки,
+                # запись строк
+                (f'/api/recipes/{recipe}/shopping_cart/', 7, 6),
+                # и лента: счётчик подписчиков для порога раскладки,
+                # рецепты автора, записи ленты; рецепты для ответа
+                (f'/api/users/{author}/subscribe/', 8, 5)):
+            self.assertEqual(self.statements(client, 'post', url),
+                             (201, added))
+            self.assertEqual(self.statements(client, 'delete', url),
+                             (204, removed))
+
+
+class ToggleConcurrencyTest(APITransactionTestCase):
+    threads = 8
+    rounds = 3
+
+    def setUp(self):
+        super().setUp()
+        create_toggle_data(self)
+        token = Token.objects.create(user=self.user)
+        self.clients = []
+        for _ in range(self.threads):
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+            self.clients.append(client)
+        # ответы 400 здесь ожидаемы; 500 по-прежнему попадут в лог
+        request_logger = logging.getLogger('django.request')
+        self.addCleanup(request_logger.setLevel, request_logger.level)
+        request_logger.setLevel(logging.ERROR)
+
+    def wave(self, requests):
+        """Потоки отправляют запросы [(клиент, метод, url, данные)]
+        одновременно."""
+        barrier = threading.Barrier(len(requests))
+        statuses = []
+
+        def send(client, method, url, data):
+            try:
+                barrier.wait()
+                response = getattr(client, method)(url, data, format='json')
+                statuses.append(response.status_code)
+            except Exception as error:
+                statuses.append(repr(error))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=send, args=request)
+                   for request in requests]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return Counter(statuses)
+
+    def assert_consistent(self, label):
+        self.recipe.refresh_from_db()
+        self.author.refresh_from_db()
+        with self.subTest(label):
+            self.assertEqual(self.recipe.favorites_count,
+                             Favorite.objects.count())
+            self.assertEqual(self.recipe.in_carts_count,
+                             ShoppingCart.objects.count())
+            self.assertEqual(self.author.subscribers_count,
+                             Subscribe.objects.filter(
+                                 author=self.author).count())
+            self.assertEqual(
+                dict(ShoppingCartIngredient.objects.filter(
+                    user=self.user).values_list('ingredient_id', 'amount')),
+                {row['ingredient_id']: row['total'] for row in
+                 ShoppingCartIngredient.objects.live_totals([self.user.pk])})
+            subscribed = Subscribe.objects.filter(
+                user=self.user, author=self.author).exists()
+            self.assertEqual(
+                FeedEntry.objects.filter(user=self.user).count(),
+                int(subscribed))
+
+    def test_concurrent_toggles(self):
+        targets = (
+            (f'/api/recipes/{self.recipe.pk}/favorite/',
+             '/api/recipes/favorite/batch/', self.recipe.pk),
+            (f'/api/recipes/{self.recipe.pk}/shopping_cart/',
+             '/api/recipes/shopping_cart/batch/', self.recipe.pk),
+            (f'/api/users/{self.author.pk}/subscribe/',
+             '/api/users/subscribe/batch/', self.author.pk),
+        )
+        for number in range(self.rounds):
+            for url, batch_url, pk in targets:
+                for method, success, key in (('post', 201, 'add'),
+                                             ('delete', 204, 'remove')):
+                    label = f'раунд {number}, {method.upper()} {url}'
+                    # ровно один одиночный запрос успешен, остальные 400
+                    statuses = self.wave([
+                        (client, method, url, None)
+                        for client in self.clients])
+                    self.assertEqual(statuses, Counter({
+                        success: 1, 400: self.threads - 1}), label)
+                    self.assert_consistent(label)
+                    # каждый второй поток шлёт пакет: он отвечает 200
+                    # и при изменении, и при повторе
+                    statuses = self.wave([
+                        (client, 'post', batch_url, {key: [pk]})
+                        if position % 2 else (client, method, url, None)
+                        for position, client in enumerate(self.clients)])
+                    self.assertEqual(
+                        statuses[success] + statuses[400] + statuses[200],
+                        self.threads, label)
+                    self.assert_consistent(f'{label} и {batch_url}')
+
+    def test_crossed_subscriptions(self):
+        # A подписывается на B, пока B подписывается на A
+        client = self.client_for(self.author)
+        for method, success in (('post', 201), ('delete', 204)):
+            statuses = self.wave([
+                (self.clients[0], method,
+                 f'/api/users/{self.author.pk}/subscribe/', None),
+                (client, method,
+                 f'/api/users/{self.user.pk}/subscribe/', None),
+            ])
+            self.assertEqual(statuses, Counter({success: 2}))
+        self.assertEqual(
+            list(User.objects.values_list('subscribers_count', flat=True)),
+            [0, 0])
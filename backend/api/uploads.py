@@ -0,0 +1,110 @@
+import io
+import json
+
+from django.conf import settings
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.http.multipartparser import \
+    MultiPartParser as DjangoMultiPartParser
+from django.http.multipartparser import MultiPartParserError
+from django.utils.datastructures import MultiValueDict
+from PIL import Image
+from rest_framework import status
+from rest_framework.exceptions import (APIException, ParseError,
+                                       ValidationError)
+from rest_framework.parsers import DataAndFiles, JSONParser, MultiPartParser
+
+
+class UploadTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'слишком большой запрос'
+    default_code = 'upload_too_large'
+
+
+def max_body_size(file_size):
+    """Файл плюс обычные поля формы, ограниченные
+    DATA_UPLOAD_MAX_MEMORY_SIZE."""
+    return file_size + (settings.DATA_UPLOAD_MAX_MEMORY_SIZE or 0)
+
+
+def check_image_header(file):
+    """Проверяет формат и размеры по заголовку, не декодируя пиксели."""
+    if file.size > settings.RECIPE_IMAGE_MAX_SIZE:
+        raise UploadTooLarge(
+            'изображение больше '
+            f'{settings.RECIPE_IMAGE_MAX_SIZE // 2 ** 20} МБ')
+    file.seek(0)
+    try:
+        with Image.open(file) as image:
+            image_format, (width, height) = image.format, image.size
+    except (OSError, Image.DecompressionBombError):
+        raise ValidationError('загрузите корректное изображение')
+    finally:
+        file.seek(0)
+    if image_format not in settings.RECIPE_IMAGE_FORMATS:
+        raise ValidationError(
+            'допустимые форматы: '
+            + ', '.join(settings.RECIPE_IMAGE_FORMATS).lower())
+    side = settings.RECIPE_IMAGE_MAX_SIDES[image_format]
+    if width > side or height > side:
+        raise ValidationError(f'изображение больше {side}×{side} пикселей')
+
+
+class LimitedTemporaryFileUploadHandler(TemporaryFileUploadHandler):
+    """Пишет файлы сразу во временный файл и прерывает загрузку,
+    как только тело запроса или файл превышают допустимый размер."""
+
+    def handle_raw_input(self, input_data, META, content_length, boundary,
+                         encoding=None):
+        if content_length > max_body_size(settings.RECIPE_IMAGE_MAX_SIZE):
+            raise UploadTooLarge()
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > settings.RECIPE_IMAGE_MAX_SIZE:
+            self.file.close()
+            raise UploadTooLarge()
+        return super().receive_data_chunk(raw_data, start)
+
+
+class LimitedJSONParser(JSONParser):
+    """JSON с изображением в base64: тело длиннее допустимого
+    отклоняется до разбора."""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        limit = max_body_size(settings.RECIPE_IMAGE_MAX_SIZE * 4 // 3)
+        data = stream.read(limit + 1) if stream is not None else b''
+        if len(data) > limit:
+            raise UploadTooLarge()
+        return super().parse(io.BytesIO(data), media_type, parser_context)
+
+
+class RecipeMultiPartParser(MultiPartParser):
+    """multipart/form-data для рецептов: файлы пишутся на диск,
+    вложенные поля передаются строками JSON."""
+    json_fields = ('ingredients', 'tags')
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        request = parser_context['request']
+        meta = request.META.copy()
+        meta['CONTENT_TYPE'] = media_type
+        try:
+            data, files = DjangoMultiPartParser(
+                meta, stream, [LimitedTemporaryFileUploadHandler(request)],
+                parser_context.get('encoding', settings.DEFAULT_CHARSET)
+            ).parse()
+        except MultiPartParserError as exc:
+            raise ParseError(f'ошибка разбора multipart: {exc}')
+        parsed = {}
+        for key, values in data.lists():
+            if key in self.json_fields:
+                try:
+                    values = [json.loads(value) for value in values]
+                except ValueError:
+                    raise ParseError(f'поле {key} должно быть JSON')
+                parsed[key] = (values[0] if len(values) == 1
+                               and isinstance(values[0], list) else values)
+            else:
+                parsed[key] = values[-1]
+        # Файлы кладутся в data обычным словарём: иначе request.data
+        # получит списки из MultiValueDict.
+        parsed.update(files.dict())
+        return DataAndFiles(parsed, MultiValueDict())
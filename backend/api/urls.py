@@ -1,8 +1,9 @@
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
-from .views import (TagViewSet, IngredientViewSet,
-                    RecipeViewSet, ListSubscribeViewSet, SubscribeApiView)
+from .views import (TagViewSet, IngredientViewSet, MetricsView,
+                    RecipeViewSet, ListSubscribeViewSet, SubscribeApiView,
+                    SubscribeBatchApiView)
 
 app_name = 'api'
 
@@ -13,8 +14,11 @@ router.register(r'recipes', RecipeViewSet)
 router.register(r'tags', TagViewSet)
 
 urlpatterns = [
+    path('_metrics', MetricsView.as_view(), name='metrics'),
     path('users/<int:id>/subscribe/', SubscribeApiView.as_view(),
          name='subscribe'),
+    path('users/subscribe/batch/', SubscribeBatchApiView.as_view(),
+         name='subscribe_batch'),
     path('users/subscriptions/', ListSubscribeViewSet.as_view(),
          name='subscriptions'),
     path('', include(router.urls)),
@@ -1,13 +1,229 @@
-from django.http import HttpResponse
+import csv
+import hashlib
+import io
+import json
 
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response
 
-def get_shopping_list(ingredients_list):
-    buy_list = []
-    for item in ingredients_list:
-        buy_list.append(f'{item["ingredient__name"]} - {item["amount"]} '
-                        f'{item["ingredient__measurement_unit"]} \n')
+from recipes.models import ShoppingCartIngredient
+from recipes.versions import get_version
 
-    response = HttpResponse(buy_list, 'Content-Type: text/plain')
-    response['Content-Disposition'] = ('attachment; '
-                                       'filename="buylist.txt"')
+# метка пользователя как автора: его данные встроены в ответы рецептов
+AUTHOR_VERSION_NAME = 'author:{}'
+CHUNK_SIZE = 500
+PDF_PAGE_WIDTH = 595
+PDF_PAGE_HEIGHT = 842
+PDF_MARGIN = 50
+PDF_FONT_SIZE = 11
+PDF_LEADING = 14
+PDF_LINES_PER_PAGE = (PDF_PAGE_HEIGHT - 2 * PDF_MARGIN) // PDF_LEADING
+PDF_ENCODING = 'cp1251'
+
+
+def get_recipes_limit(request):
+    """Число рецептов автора в подписках из ?recipes_limit=."""
+    try:
+        limit = int(request.GET.get('recipes_limit', settings.RECIPES_LIMIT))
+    except ValueError:
+        limit = settings.RECIPES_LIMIT
+    return max(0, min(limit, settings.RECIPES_MAX_LIMIT))
+
+
+def get_shopping_list_rows(user):
+    return ShoppingCartIngredient.objects.filter(user=user).values(
+        'ingredient__name',
+        'ingredient__measurement_unit',
+        'amount',
+    ).order_by('ingredient__name')
+
+
+def get_shopping_list_etag(user, export_format):
+    """Отпечаток содержимого сводной корзины пользователя: хэш строк
+    (ингредиент, количество) и версии справочника ингредиентов,
+    чтобы переименование продукта тоже меняло ответ."""
+    digest = hashlib.sha1(
+        f'{export_format}:{get_version("ingredients")}'.encode())
+    rows = ShoppingCartIngredient.objects.filter(user=user).values_list(
+        'ingredient_id', 'amount').order_by('ingredient_id')
+    for ingredient_id, amount in rows.iterator(chunk_size=CHUNK_SIZE):
+        digest.update(f';{ingredient_id}:{amount}'.encode())
+    return f'"{digest.hexdigest()}"'
+
+
+def format_line(item):
+    return (f'{item["ingredient__name"]} - {item["amount"]} '
+            f'{item["ingredient__measurement_unit"]}')
+
+
+def render_txt(rows):
+    for item in rows:
+        yield f'{format_line(item)} \n'
+
+
+def render_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(('ингредиент', 'количество', 'единица измерения'))
+    for item in rows:
+        writer.writerow((item['ingredient__name'], item['amount'],
+                         item['ingredient__measurement_unit']))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def render_json(rows):
+    yield '['
+    separator = ''
+    for item in rows:
+        yield separator + json.dumps({
+            'name': item['ingredient__name'],
+            'amount': item['amount'],
+            'measurement_unit': item['ingredient__measurement_unit'],
+        }, ensure_ascii=False)
+        separator = ',\n'
+    yield ']\n'
+
+
+def pdf_text(line):
+    text = line.encode(PDF_ENCODING, errors='replace')
+    return (text.replace(b'\\', b'\\\\').replace(b'(', b'\\(')
+            .replace(b')', b'\\)'))
+
+
+def pdf_font_encoding():
+    """Кодировка cp1251 для стандартного шрифта Courier: кириллические
+    байты отображаются на глифы uniXXXX, которые просмотрщик находит
+    в подставленном системном шрифте."""
+    differences = []
+    for code in range(128, 256):
+        try:
+            char = bytes([code]).decode(PDF_ENCODING)
+        except UnicodeDecodeError:
+            continue
+        differences.append(f'{code} /uni{ord(char):04X}')
+    return ' '.join(differences)
+
+
+def pdf_to_unicode():
+    """CMap для копирования и поиска текста в просмотрщике."""
+    mappings = []
+    for code in range(32, 256):
+        try:
+            char = bytes([code]).decode(PDF_ENCODING)
+        except UnicodeDecodeError:
+            continue
+        mappings.append(f'<{code:02X}> <{ord(char):04X}>')
+    chunks = [mappings[i:i + 100] for i in range(0, len(mappings), 100)]
+    body = '\n'.join(
+        f'{len(chunk)} beginbfchar\n' + '\n'.join(chunk) + '\nendbfchar'
+        for chunk in chunks
+    )
+    return (
+        '/CIDInit /ProcSet findresource begin\n12 dict begin\nbegincmap\n'
+        '/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 '
+        '>> def\n/CMapName /Adobe-Identity-UCS def\n/CMapType 2 def\n'
+        '1 begincodespacerange\n<00> <FF>\nendcodespacerange\n'
+        f'{body}\nendcmap\nCMapName currentdict /CMapResource '
+        'defineresource pop\nend\nend'
+    ).encode()
+
+
+def render_pdf(rows):
+    """Пишет PDF постранично: каждая страница отдаётся клиенту сразу,
+    а таблица ссылок xref собирается из смещений в конце файла."""
+    offsets = {}
+    position = 0
+
+    def emit(number, body):
+        nonlocal position
+        data = f'{number} 0 obj\n'.encode() + body + b'\nendobj\n'
+        offsets[number] = position
+        position += len(data)
+        return data
+
+    def page(number, lines):
+        commands = [
+            b'BT',
+            f'/F1 {PDF_FONT_SIZE} Tf {PDF_LEADING} TL'.encode(),
+            f'{PDF_MARGIN} {PDF_PAGE_HEIGHT - PDF_MARGIN} Td'.encode(),
+        ]
+        commands.extend(b'(' + pdf_text(line) + b') Tj T*'
+                        for line in lines)
+        commands.append(b'ET')
+        stream = b'\n'.join(commands)
+        content = emit(number, b'<< /Length %d >>\nstream\n' % len(stream)
+                       + stream + b'\nendstream')
+        return content + emit(number + 1, (
+            f'<< /Type /Page /Parent 2 0 R '
+            f'/MediaBox [0 0 {PDF_PAGE_WIDTH} {PDF_PAGE_HEIGHT}] '
+            f'/Resources << /Font << /F1 3 0 R >> >> '
+            f'/Contents {number} 0 R >>'
+        ).encode())
+
+    header = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+    position = len(header)
+    yield header
+    yield emit(3, (
+        '<< /Type /Font /Subtype /Type1 /BaseFont /Courier '
+        '/FirstChar 32 /LastChar 255 /Widths [{widths}] '
+        '/Encoding << /Type /Encoding /BaseEncoding /WinAnsiEncoding '
+        '/Differences [{differences}] >> /ToUnicode 4 0 R >>'
+    ).format(widths=' '.join(['600'] * 224),
+             differences=pdf_font_encoding()).encode())
+    cmap = pdf_to_unicode()
+    yield emit(4, b'<< /Length %d >>\nstream\n' % len(cmap)
+               + cmap + b'\nendstream')
+
+    kids = []
+    number = 5
+    lines = ['Список покупок', '']
+    for item in rows:
+        lines.append(format_line(item))
+        if len(lines) == PDF_LINES_PER_PAGE:
+            yield page(number, lines)
+            kids.append(number + 1)
+            number += 2
+            lines = []
+    if lines or not kids:
+        yield page(number, lines)
+        kids.append(number + 1)
+        number += 2
+
+    yield emit(2, '<< /Type /Pages /Kids [{}] /Count {} >>'.format(
+        ' '.join(f'{kid} 0 R' for kid in kids), len(kids)).encode())
+    yield emit(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+    xref = [f'xref\n0 {number}\n'.encode(), b'0000000000 65535 f \n']
+    xref.extend(f'{offsets[obj]:010d} 00000 n \n'.encode()
+                for obj in range(1, number))
+    yield b''.join(xref) + (
+        f'trailer\n<< /Size {number} /Root 1 0 R >>\n'
+        f'startxref\n{position}\n%%EOF\n'
+    ).encode()
+
+
+SHOPPING_LIST_WRITERS = {
+    'txt': render_txt,
+    'csv': render_csv,
+    'json': render_json,
+    'pdf': render_pdf,
+}
+
+
+def get_shopping_list(request, user, export_format, content_type):
+    etag = get_shopping_list_etag(user, export_format)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        rows = get_shopping_list_rows(user).iterator(chunk_size=CHUNK_SIZE)
+        response = StreamingHttpResponse(
+            SHOPPING_LIST_WRITERS[export_format](rows),
+            content_type=content_type
+        )
+        response['Content-Disposition'] = (
+            f'attachment; filename="buylist.{export_format}"')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
     return response
@@ -1,30 +1,49 @@
-from django.db.models import Sum
+import hashlib
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch, Value
 from django.contrib.auth import get_user_model
 from django_filters.rest_framework import DjangoFilterBackend
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 
 from djoser.views import UserViewSet
 
 from rest_framework import viewsets, generics, permissions, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.generics import get_object_or_404
 from rest_framework.permissions import (IsAuthenticated,
                                         IsAuthenticatedOrReadOnly)
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.views import APIView
 
-from recipes.models import (Tag, Ingredient, Recipe, IngredientAmount,
-                            ShoppingCart, Favorite)
+from recipes.models import Tag, Ingredient, Recipe, ShoppingCart, Favorite
+from recipes.signals import delete_and_notify
+from recipes.versions import get_version
 from users.models import Subscribe
 
+from .batch import (change_recipes, change_subscriptions, clear_recipes,
+                    lock_users)
+from .feed import decode_cursor, feed_page
 from .filters import IngredientsFilter, RecipeFilter
-from .paginations import CustomPagination
-from .permissions import (IsAuthorOrAdmin)
+from .mixins import ConditionalGetMixin
+from .paginations import CustomPagination, RecipeCursorPagination
+from .metrics import registry, render_prometheus
+from .permissions import IsAdmin, IsAuthorOrAdmin
+from .renderers import SHOPPING_LIST_RENDERERS, PrometheusRenderer
+from .search import (ingredient_index, recipe_ingredient_index,
+                     search_ingredients)
 from .serializers import (TagSerializer, IngredientSerializer,
                           CustomUserSerializer, SubscribeViewSerializer,
                           AddRecipeSerializer, ShowRecipeFullSerializer,
-                          FavoriteSerializer)
-from .utils import get_shopping_list
+                          FavoriteSerializer, RecipeCoverageSerializer,
+                          BatchSerializer)
+from .uploads import LimitedJSONParser, RecipeMultiPartParser
+from .utils import (AUTHOR_VERSION_NAME, get_recipes_limit,
+                    get_shopping_list)
 
 User = get_user_model()
 
@@ -42,9 +61,20 @@ class SubscribeApiView(APIView):
         pk = kwargs.get('id')
         author = get_object_or_404(User, pk=pk)
         user = request.user
-        obj = Subscribe(author=author, user=user)
-        obj.save()
-
+        if author == user:
+            return Response({
+                'errors': 'нельзя подписаться на самого себя'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            with transaction.atomic():
+                lock_users(user.pk, author.pk)
+                Subscribe.objects.create(author=author, user=user)
+        except IntegrityError:
+            return Response({
+                'errors': 'вы уже подписаны на этого автора'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        # подписка только что создана, проверять её запросом не нужно
+        author.is_subscribed = True
         serializer = SubscribeViewSerializer(
             author, context={'request': request})
 
@@ -52,17 +82,30 @@ class SubscribeApiView(APIView):
 
     def delete(self, request, id):
         user = request.user
-        author = get_object_or_404(User, id=id)
-        try:
-            subscription = get_object_or_404(Subscribe, user=user,
-                                             author=author)
-            subscription.delete()
+        with transaction.atomic():
+            lock_users(user.pk, id)
+            deleted = delete_and_notify(
+                Subscribe.objects.filter(user=user, author_id=id),
+                Subscribe(user=user, author_id=id))
+        if deleted:
             return Response(status=status.HTTP_204_NO_CONTENT)
-        except Subscribe.DoesNotExist:
-            return Response(
-                'не удалось отписаться',
-                status=status.HTTP_400_BAD_REQUEST,
-            )
+        get_object_or_404(User, id=id)
+        return Response(
+            'не удалось отписаться',
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+
+class SubscribeBatchApiView(APIView):
+    """Подписка на авторов и отписка от них одним запросом:
+    {"add": [id, ...], "remove": [id, ...]}."""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        serializer = BatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response({'results': change_subscriptions(
+            request.user, **serializer.validated_data)})
 
 
 class ListSubscribeViewSet(generics.ListAPIView):
@@ -73,15 +116,61 @@ class ListSubscribeViewSet(generics.ListAPIView):
 
     def get_queryset(self):
         user = self.request.user
-        return User.objects.filter(subscribing__user=user)
+        recipes_limit = get_recipes_limit(self.request)
+        return User.objects.filter(subscribing__user=user).annotate(
+            is_subscribed=Value(True),
+        ).prefetch_related(Prefetch(
+            'recipes',
+            queryset=Recipe.objects.first_per_author(recipes_limit),
+            to_attr='limited_recipes',
+        ))
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
     permission_classes = (IsAuthorOrAdmin,)
     serializer_class = ShowRecipeFullSerializer
     filter_backends = (DjangoFilterBackend,)
     filterset_class = RecipeFilter
+    parser_classes = (LimitedJSONParser, RecipeMultiPartParser)
+    conditional_actions = ('retrieve',)
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params
+            if (params.get('pagination') == 'cursor'
+                    or RecipeCursorPagination.cursor_query_param in params):
+                self._paginator = RecipeCursorPagination()
+            else:
+                self._paginator = super().paginator
+        return self._paginator
+
+    def get_version_stamp(self, request):
+        user = request.user
+        try:
+            flags = Recipe.objects.filter(
+                pk=self.kwargs['pk']
+            ).with_version(user).values_list(
+                'author_id', 'updated_at', 'is_favorited',
+                'is_in_shopping_cart', 'author_is_subscribed'
+            ).first()
+        except (TypeError, ValueError):
+            return None
+        if flags is None:
+            return None
+        # автор встроен в ответ, а его изменения сбрасывают его метку
+        author_version = get_version(AUTHOR_VERSION_NAME.format(flags[0]))
+        signature = (f'{self.kwargs["pk"]}:{user.pk}:{flags}:'
+                     f'{get_version("tags")}:{get_version("ingredients")}:'
+                     f'{author_version}')
+        return f'W/"{hashlib.sha1(signature.encode()).hexdigest()}"', None
+
+    def get_queryset(self):
+        if self.action in ('list', 'retrieve'):
+            user = self.request.user
+            return Recipe.objects.with_user_flags(user).with_related(user)
+        return Recipe.objects.all()
 
     def get_serializer_class(self):
         if self.request.method == "GET":
@@ -89,19 +178,31 @@ class RecipeViewSet(viewsets.ModelViewSet):
         return AddRecipeSerializer
 
     def add_recipe(self, model, user, pk):
-        if model.objects.filter(user=user, recipe__id=pk).exists():
+        recipe = get_object_or_404(Recipe, id=pk)
+        # повтор ловится уникальным ограничением, а не проверкой
+        # заранее: два одновременных запроса не приводят к 500
+        try:
+            with transaction.atomic():
+                lock_users(user.pk)
+                model.objects.create(user=user, recipe=recipe)
+        except IntegrityError:
             return Response({
                 'errors': 'рецепт уже добавлен в список'
             }, status=status.HTTP_400_BAD_REQUEST)
-        recipe = get_object_or_404(Recipe, id=pk)
-        model.objects.create(user=user, recipe=recipe)
         serializer = FavoriteSerializer(recipe)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     def delete_recipe(self, model, user, pk):
-        obj = model.objects.filter(user=user, recipe__id=pk)
-        if obj.exists():
-            obj.delete()
+        try:
+            recipe_id = int(pk)
+        except ValueError:
+            raise Http404
+        with transaction.atomic():
+            lock_users(user.pk)
+            deleted = delete_and_notify(
+                model.objects.filter(user=user, recipe_id=recipe_id),
+                model(user=user, recipe_id=recipe_id))
+        if deleted:
             return Response(status=status.HTTP_204_NO_CONTENT)
         return Response({
             'errors': 'рецепт уже удален'
@@ -131,33 +232,184 @@ class RecipeViewSet(viewsets.ModelViewSet):
         else:
             return self.delete_recipe(ShoppingCart, request.user, pk)
 
+    def batch_recipes(self, model, request):
+        serializer = BatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response({'results': change_recipes(
+            model, request.user, **serializer.validated_data)})
+
+    @action(
+        detail=False,
+        methods=["POST"],
+        url_path='favorite/batch',
+        permission_classes=[IsAuthenticated],
+    )
+    def favorite_batch(self, request):
+        """Добавляет и убирает рецепты избранного одним запросом:
+        {"add": [id, ...], "remove": [id, ...]}."""
+        return self.batch_recipes(Favorite, request)
+
+    @action(
+        detail=False,
+        methods=["POST"],
+        url_path='shopping_cart/batch',
+        permission_classes=[IsAuthenticated],
+    )
+    def shopping_cart_batch(self, request):
+        """Добавляет и убирает рецепты корзины одним запросом."""
+        return self.batch_recipes(ShoppingCart, request)
+
+    @action(
+        detail=False,
+        methods=["DELETE"],
+        url_path='favorite',
+        permission_classes=[IsAuthenticated],
+    )
+    def clear_favorite(self, request):
+        return Response(
+            {'results': clear_recipes(Favorite, request.user)})
+
+    @action(
+        detail=False,
+        methods=["DELETE"],
+        url_path='shopping_cart',
+        permission_classes=[IsAuthenticated],
+    )
+    def clear_shopping_cart(self, request):
+        return Response(
+            {'results': clear_recipes(ShoppingCart, request.user)})
+
+    @action(
+        detail=False,
+        methods=["GET"],
+        url_path='by_ingredients',
+    )
+    def by_ingredients(self, request):
+        """Рецепты по имеющимся ингредиентам:
+        ?ingredients=1&ingredients=2 или ?ingredients=1,2."""
+        try:
+            ingredients = {
+                int(value)
+                for param in request.query_params.getlist('ingredients')
+                for value in param.split(',') if value.strip()
+            }
+        except ValueError:
+            raise ValidationError(
+                {'ingredients': 'ожидаются id ингредиентов'})
+        if not ingredients:
+            raise ValidationError(
+                {'ingredients': 'укажите хотя бы один ингредиент'})
+        paginator = CustomPagination()
+        page = paginator.paginate_queryset(
+            recipe_ingredient_index.rank(ingredients), request, view=self)
+        serializer = RecipeCoverageSerializer(
+            self.get_recipes_in_order(page), many=True,
+            context={**self.get_serializer_context(),
+                     'ingredients': ingredients})
+        return paginator.get_paginated_response(serializer.data)
+
     @action(
         detail=False,
         methods=["GET"],
         permission_classes=[IsAuthenticated],
+    )
+    def feed(self, request):
+        """Рецепты авторов из подписок, от новых к старым; следующая
+        страница — по ссылке next."""
+        try:
+            size = int(request.query_params.get(
+                'limit', settings.FEED_PAGE_SIZE))
+        except ValueError:
+            size = settings.FEED_PAGE_SIZE
+        size = max(1, min(size, settings.FEED_MAX_PAGE_SIZE))
+        cursor = request.query_params.get('cursor')
+        ids, next_cursor = feed_page(
+            request.user, size, cursor and decode_cursor(cursor))
+        serializer = ShowRecipeFullSerializer(
+            self.get_recipes_in_order(ids), many=True,
+            context=self.get_serializer_context())
+        next_url = None
+        if next_cursor:
+            next_url = replace_query_param(
+                request.build_absolute_uri(), 'cursor', next_cursor)
+        return Response({'next': next_url, 'results': serializer.data})
+
+    def get_recipes_in_order(self, ids):
+        """Рецепты с флагами пользователя в порядке ids; удалённые
+        за это время пропускаются."""
+        user = self.request.user
+        recipes = Recipe.objects.filter(pk__in=ids).with_user_flags(
+            user).with_related(user).in_bulk()
+        return [recipes[pk] for pk in ids if pk in recipes]
+
+    @action(
+        detail=False,
+        methods=["GET"],
+        permission_classes=[IsAuthenticated],
+        renderer_classes=SHOPPING_LIST_RENDERERS,
         url_path='download_shopping_cart',
     )
     def download_shopping_cart(self, request):
-        ingredients_list = IngredientAmount.objects.filter(
-            recipe__shopping_cart__user=request.user
-        ).values(
-            'ingredient__name',
-            'ingredient__measurement_unit'
-        ).annotate(amount=Sum('amount'))
-        return get_shopping_list(ingredients_list)
+        renderer = request.accepted_renderer
+        content_type = renderer.media_type
+        if renderer.charset:
+            content_type = f'{content_type}; charset={renderer.charset}'
+        return get_shopping_list(
+            request, request.user, renderer.format, content_type)
 
 
-class TagViewSet(viewsets.ReadOnlyModelViewSet):
+class TagViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     pagination_class = None
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = (IsAuthenticatedOrReadOnly,)
 
+    cache_control = {'public': True, 'no_cache': True}
 
-class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
+    def get_version_stamp(self, request):
+        version = get_version('tags')
+        return f'W/"tags-{version}"', version
+
+
+class IngredientViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     pagination_class = None
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     permission_classes = (IsAuthenticatedOrReadOnly,)
     filter_backends = (DjangoFilterBackend,)
     filterset_class = IngredientsFilter
+
+    cache_control = {'public': True, 'no_cache': True}
+
+    def get_version_stamp(self, request):
+        version = get_version('ingredients')
+        return f'W/"ingredients-{version}"', version
+
+    def list(self, request, *args, **kwargs):
+        not_modified = self.conditional_response(request)
+        if not_modified:
+            return not_modified
+        search = request.query_params.get('search')
+        if search:
+            try:
+                limit = int(request.query_params.get(
+                    'limit', settings.INGREDIENT_SEARCH_LIMIT))
+            except ValueError:
+                limit = settings.INGREDIENT_SEARCH_LIMIT
+            limit = max(1, min(limit, settings.INGREDIENT_SEARCH_MAX_LIMIT))
+            return Response(search_ingredients(search, limit))
+        name = request.query_params.get('name')
+        if name:
+            return Response(ingredient_index.search(name))
+        return super().list(request, *args, **kwargs)
+
+
+class MetricsView(APIView):
+    """Метрики по маршрутам в формате Prometheus, суммарно по воркерам."""
+    permission_classes = (IsAdmin,)
+    renderer_classes = (PrometheusRenderer,)
+
+    def get(self, request):
+        return Response(
+            render_prometheus(registry.collect()),
+            content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -8,7 +9,7 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 SECRET_KEY = os.getenv('SECRET',
                        default='django-insecure-x3(1fpjn7b+ap=egt_7r=3hanqwl^0rc(mueln(&gk-swqok1@')
 
-DEBUG = True
+DEBUG = os.getenv('DEBUG', default='True').lower() == 'true'
 ALLOWED_HOSTS = ['*']
 
 INSTALLED_APPS = [
@@ -21,6 +22,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'rest_framework.authtoken',
     'djoser',
@@ -31,6 +33,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -71,6 +74,37 @@ DATABASES = {
     }
 }
 
+if DATABASES['default']['ENGINE'].endswith('sqlite3'):
+    # тестовая база в файле: в общем кэше базы в памяти другие потоки
+    # не читают таблицы, изменённые незафиксированной транзакцией,
+    # а получают ошибку блокировки
+    DATABASES['default']['TEST'] = {
+        'NAME': os.path.join(tempfile.gettempdir(), 'foodgram_test.sqlite3'),
+    }
+
+# Метки версий (recipes/versions.py), отпечатки ответов, индексы поиска
+# и кэш токенов согласованы между воркерами только через общий кэш:
+# при нескольких процессах задайте CACHE_BACKEND вроде Redis или
+# Memcached. С локальным кэшем токены не кэшируются, если не указано
+# SINGLE_PROCESS=True (runserver, один воркер gunicorn).
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND',
+            default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', default=''),
+    }
+}
+
+SINGLE_PROCESS = os.getenv('SINGLE_PROCESS', default='False').lower() == 'true'
+
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', default=10000))
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', default=300))
+TOKEN_CACHE_ALIAS = os.getenv('TOKEN_CACHE_ALIAS') or None
+
+METRICS_DIR = os.getenv('METRICS_DIR') or None
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', default=1))
+
 AUTH_USER_MODEL = 'users.User'
 
 AUTH_PASSWORD_VALIDATORS = [
@@ -111,7 +145,7 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend',
@@ -146,3 +180,20 @@ ACCOUNT_AUTHENTICATION_METHOD = 'email'
 ACCOUNT_EMAIL_REQUIRED = True
 ACCOUNT_USERNAME_REQUIRED = False
 RECIPES_LIMIT = 10
+RECIPES_MAX_LIMIT = 100
+INGREDIENT_SEARCH_LIMIT = 20
+INGREDIENT_SEARCH_MAX_LIMIT = 100
+RECIPE_INDEX_SYNC_OVERLAP = 5
+FEED_FANOUT_LIMIT = int(os.getenv('FEED_FANOUT_LIMIT', default=1000))
+FEED_PAGE_SIZE = 6
+FEED_MAX_PAGE_SIZE = 100
+BATCH_MAX_SIZE = 100
+RECIPE_IMAGE_WIDTHS = (200, 480, 1024)
+RECIPE_IMAGE_MAX_SIZE = 10 * 2 ** 20
+# JPEG декодируется сразу уменьшенным (Image.draft), остальные форматы
+# целиком: копии из 3000×3000 PNG требуют около 50 МБ RSS, из 2000×2000
+# WebP — около 65 МБ, а из 6000×6000 JPEG — около 20 МБ
+RECIPE_IMAGE_MAX_SIDES = {
+    'JPEG': 6000, 'PNG': 3000, 'GIF': 3000, 'WEBP': 2000,
+}
+RECIPE_IMAGE_FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP')
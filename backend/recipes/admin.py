@@ -1,7 +1,7 @@
 from django.contrib import admin
 
 from .models import (Favorite, Ingredient, Recipe, IngredientAmount,
-                     ShoppingCart, Tag, RecipeTag)
+                     ShoppingCart, ShoppingCartIngredient, Tag, RecipeTag)
 
 
 class IngredientAmountInline(admin.TabularInline):
@@ -22,8 +22,20 @@ class RecipeAdmin(admin.ModelAdmin):
     list_filter = ('name', 'author', 'tags')
     inlines = (IngredientAmountInline, RecipeTagsInline)
 
+    def save_related(self, request, form, formsets, change):
+        # инлайн пишет IngredientAmount напрямую, поэтому сводные
+        # корзины поправляются по разнице количеств до и после
+        recipe = form.instance
+        carts = ShoppingCartIngredient.objects
+        old_amounts = carts.recipe_amounts([recipe])
+        super().save_related(request, form, formsets, change)
+        Recipe.objects.filter(pk=recipe.pk).update_tags_mask()
+        carts.change_recipe(
+            recipe, old_amounts, carts.recipe_amounts([recipe]))
+
+    @admin.display(description='в избранном', ordering='favorites_count')
     def favorite(self, obj):
-        return obj.favorite.all().count()
+        return obj.favorites_count
 
 
 @admin.register(Ingredient)
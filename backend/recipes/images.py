@@ -0,0 +1,111 @@
+import io
+import logging
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVE_FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 85, 'optimize': True, 'progressive': True}),
+}
+
+
+EXIF_ORIENTATION = 0x0112
+# после этих поворотов ширина картинки — её сохранённая высота
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def derivative_name(name, width, extension):
+    root, _ = os.path.splitext(name)
+    return f'{root}_{width}w.{extension}'
+
+
+def derivative_names(name):
+    for extension in DERIVATIVE_FORMATS:
+        for width in settings.RECIPE_IMAGE_WIDTHS:
+            yield extension, width, derivative_name(name, width, extension)
+
+
+def render_derivative(image, width, image_format, options):
+    if image.width > width:
+        height = max(1, round(image.height * width / image.width))
+        image = image.resize((width, height), Image.LANCZOS)
+    if image_format == 'JPEG' and image.mode != 'RGB':
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A')
+                         if 'A' in image.getbands() else None)
+        image = background
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+def open_scaled(file, width):
+    """Открывает изображение не шире width после поворота по EXIF.
+
+    JPEG сразу декодируется уменьшенным в 2–8 раз (draft), остальные
+    форматы уменьшаются до поворота и смены режима, так что
+    полноразмерные пиксели в памяти существуют в одном экземпляре.
+    """
+    image = Image.open(file)
+    oriented_width = image.width
+    if image.getexif().get(EXIF_ORIENTATION) in TRANSPOSED_ORIENTATIONS:
+        oriented_width = image.height
+    if oriented_width > width:
+        scale = width / oriented_width
+        size = (max(1, round(image.width * scale)),
+                max(1, round(image.height * scale)))
+        image.draft(None, size)
+        image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+    image = ImageOps.exif_transpose(image)
+    return image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+
+def generate_derivatives(field_file, overwrite=False):
+    """Сохраняет рядом с оригиналом уменьшенные копии в WebP и JPEG.
+
+    Копии не увеличиваются: если оригинал уже, чем нужная ширина,
+    сохраняется копия в исходном размере.
+    """
+    storage = field_file.storage
+    names = list(derivative_names(field_file.name))
+    if not overwrite and all(storage.exists(name) for _, _, name in names):
+        return 0
+    try:
+        with storage.open(field_file.name, 'rb') as file:
+            image = open_scaled(file, max(settings.RECIPE_IMAGE_WIDTHS))
+    except (OSError, ValueError):
+        logger.warning('не удалось открыть изображение %s', field_file.name)
+        return 0
+    created = 0
+    for extension, width, name in names:
+        if storage.exists(name):
+            if not overwrite:
+                continue
+            storage.delete(name)
+        image_format, options = DERIVATIVE_FORMATS[extension]
+        storage.save(name, ContentFile(
+            render_derivative(image, width, image_format, options)))
+        created += 1
+    return created
+
+
+def delete_derivatives(name, storage):
+    for _, _, derivative in derivative_names(name):
+        storage.delete(derivative)
+
+
+def derivative_srcset(field_file, build_url=None):
+    """{'webp': 'url 200w, url 480w, ...', 'jpeg': ...} без обращения
+    к хранилищу за самими файлами."""
+    srcset = {}
+    for extension, width, name in derivative_names(field_file.name):
+        url = field_file.storage.url(name)
+        if build_url is not None:
+            url = build_url(url)
+        srcset.setdefault(extension, []).append(f'{url} {width}w')
+    return {key: ', '.join(value) for key, value in srcset.items()}
@@ -0,0 +1,94 @@
+import posixpath
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from recipes.images import (delete_derivatives, derivative_names,
+                            generate_derivatives)
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = ('переносит изображения рецептов в хранилище с адресацией '
+            'по содержимому, объединяя одинаковые файлы')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='только показать, что будет сделано')
+        parser.add_argument(
+            '--delete-orphans', action='store_true',
+            help='удалить файлы, на которые не ссылается ни один рецепт')
+
+    def walk(self, storage, directory):
+        directories, files = storage.listdir(directory)
+        for name in files:
+            yield posixpath.join(directory, name)
+        for name in directories:
+            yield from self.walk(storage, posixpath.join(directory, name))
+
+    def migrate(self, storage, name, dry_run):
+        with storage.open(name, 'rb') as file:
+            new_name = storage.content_name(name, file)
+            if dry_run:
+                return new_name
+            storage.save(new_name, file)
+        Recipe.objects.filter(image=name).update(
+            image=new_name, updated_at=timezone.now())
+        storage.delete(name)
+        delete_derivatives(name, storage)
+        return new_name
+
+    def regenerate_derivatives(self, referenced):
+        for name in referenced:
+            generate_derivatives(Recipe(image=name).image)
+
+    def find_orphans(self, storage, directory, keep):
+        """Файлы каталога изображений, которых нет в keep."""
+        if not storage.exists(directory):
+            return
+        for name in self.walk(storage, directory):
+            if name not in keep:
+                yield name
+
+    def delete_orphans(self, storage, orphans, dry_run):
+        freed = 0
+        for name in orphans:
+            freed += storage.size(name)
+            if not dry_run:
+                storage.delete(name)
+        return freed
+
+    def handle(self, *args, **options):
+        field = Recipe._meta.get_field('image')
+        storage, dry_run = field.storage, options['dry_run']
+        names = set(Recipe.objects.exclude(image='').values_list(
+            'image', flat=True).order_by().distinct().iterator())
+        referenced, moved, missing = set(), 0, 0
+        for name in sorted(names):
+            if storage.is_content_name(name):
+                referenced.add(name)
+                continue
+            if not storage.exists(name):
+                missing += 1
+                self.stderr.write(f'файл не найден: {name}')
+                continue
+            referenced.add(self.migrate(storage, name, dry_run))
+            moved += 1
+        if not dry_run:
+            self.regenerate_derivatives(referenced)
+
+        keep = referenced | names
+        for name in referenced:
+            keep.update(
+                derivative for _, _, derivative in derivative_names(name))
+        orphans = list(self.find_orphans(
+            storage, field.upload_to.rstrip('/'), keep))
+        if options['delete_orphans']:
+            freed = self.delete_orphans(storage, orphans, dry_run)
+        self.stdout.write(self.style.SUCCESS(
+            f'перенесено {moved}, уникальных файлов {len(referenced)}, '
+            f'не найдено {missing}, лишних файлов {len(orphans)}'
+            + (f', освобождено {freed} байт'
+               if options['delete_orphans'] else '')
+        ))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from recipes.images import generate_derivatives
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = 'создаёт уменьшенные копии изображений для существующих рецептов'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--overwrite', action='store_true',
+            help='пересоздать уже существующие копии')
+
+    def handle(self, *args, **options):
+        recipes = created = 0
+        for recipe in Recipe.objects.exclude(image='').only(
+                'id', 'image').iterator():
+            recipes += 1
+            created += generate_derivatives(
+                recipe.image, overwrite=options['overwrite'])
+        self.stdout.write(self.style.SUCCESS(
+            f'рецептов {recipes}, создано копий {created}'))
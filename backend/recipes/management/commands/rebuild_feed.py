@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from recipes.models import FeedEntry
+
+
+class Command(BaseCommand):
+    help = ('пересобирает ленты подписок для авторов, рецепты которых '
+            'раскладываются по лентам при записи')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = FeedEntry.objects.rebuild(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'записей в лентах: {count} '
+            f'(FEED_FANOUT_LIMIT = {settings.FEED_FANOUT_LIMIT})'))
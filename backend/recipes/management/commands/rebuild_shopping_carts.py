@@ -0,0 +1,79 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from recipes.models import ShoppingCartIngredient
+
+
+class Command(BaseCommand):
+    help = ('пересобирает сводные корзины покупок и сверяет их '
+            'с суммой ингредиентов рецептов в корзинах')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify', action='store_true',
+            help='только сверить, ничего не изменяя')
+        parser.add_argument(
+            '--user', type=int, action='append', dest='users',
+            help='id пользователя (можно указать несколько раз)')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def expected(self, user_ids):
+        return {
+            (row['recipe__shopping_cart__user_id'],
+             row['ingredient_id']): row['total']
+            for row in ShoppingCartIngredient.objects.live_totals(
+                user_ids).iterator()
+        }
+
+    def stored(self, user_ids):
+        queryset = ShoppingCartIngredient.objects.all()
+        if user_ids is not None:
+            queryset = queryset.filter(user_id__in=user_ids)
+        return {
+            (user_id, ingredient_id): amount
+            for user_id, ingredient_id, amount in queryset.values_list(
+                'user_id', 'ingredient_id', 'amount').iterator()
+        }
+
+    def verify(self, user_ids):
+        expected, stored = self.expected(user_ids), self.stored(user_ids)
+        mismatches = [
+            key for key in expected.keys() | stored.keys()
+            if expected.get(key) != stored.get(key)
+        ]
+        for user_id, ingredient_id in sorted(mismatches)[:20]:
+            self.stdout.write(
+                f'пользователь {user_id}, ингредиент {ingredient_id}: '
+                f'ожидается {expected.get((user_id, ingredient_id))}, '
+                f'в сводной корзине {stored.get((user_id, ingredient_id))}')
+        return len(mismatches)
+
+    @transaction.atomic
+    def rebuild(self, user_ids, batch_size):
+        queryset = ShoppingCartIngredient.objects.all()
+        if user_ids is not None:
+            queryset = queryset.filter(user_id__in=user_ids)
+        queryset.delete()
+        rows = [
+            ShoppingCartIngredient(
+                user_id=user_id, ingredient_id=ingredient_id, amount=amount)
+            for (user_id, ingredient_id), amount
+            in self.expected(user_ids).items()
+        ]
+        ShoppingCartIngredient.objects.bulk_create(
+            rows, batch_size=batch_size)
+        return len(rows)
+
+    def handle(self, *args, **options):
+        user_ids = options['users']
+        if options['verify']:
+            mismatches = self.verify(user_ids)
+            if mismatches:
+                raise CommandError(f'расхождений: {mismatches}')
+            self.stdout.write(self.style.SUCCESS('расхождений нет'))
+            return
+        count = self.rebuild(user_ids, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'записано строк: {count}'))
+        mismatches = self.verify(user_ids)
+        if mismatches:
+            raise CommandError(f'после пересборки расхождений: {mismatches}')
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from recipes.models import Favorite, Recipe, ShoppingCart
+from recipes.signals import recount
+from users.models import Subscribe, User
+
+COUNTERS = (
+    (Recipe, 'favorites_count', Favorite, 'recipe'),
+    (Recipe, 'in_carts_count', ShoppingCart, 'recipe'),
+    (User, 'recipes_count', Recipe, 'author'),
+    (User, 'subscribers_count', Subscribe, 'author'),
+)
+
+
+class Command(BaseCommand):
+    help = ('сверяет денормализованные счётчики и маски тегов '
+            'и исправляет расхождения')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='только показать расхождения')
+
+    def reconcile(self, model, field, source, related, batch_size, dry_run):
+        fixed = 0
+        last_pk = 0
+        while True:
+            batch = list(model.objects.filter(pk__gt=last_pk).order_by(
+                'pk').values_list('pk', field)[:batch_size])
+            if not batch:
+                return fixed
+            last_pk = batch[-1][0]
+            actual = dict(source.objects.filter(**{
+                f'{related}__in': [pk for pk, _ in batch]
+            }).order_by().values_list(related).annotate(total=Count('pk')))
+            drifted = [pk for pk, stored in batch
+                       if stored != actual.get(pk, 0)]
+            fixed += len(drifted)
+            if drifted and not dry_run:
+                recount(model, drifted, field, source, related)
+
+    def handle(self, *args, **options):
+        for model, field, source, related in COUNTERS:
+            fixed = self.reconcile(model, field, source, related,
+                                   options['batch_size'], options['dry_run'])
+            self.stdout.write(
+                f'{model._meta.model_name}.{field}: расхождений {fixed}')
+        fixed = Recipe.objects.update_tags_mask(
+            options['batch_size'], options['dry_run'])
+        self.stdout.write(f'recipe.tags_mask: расхождений {fixed}')
@@ -0,0 +1,181 @@
+import io
+import random
+import time
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from PIL import Image
+
+from recipes.images import generate_derivatives
+from recipes.models import (Favorite, Ingredient, IngredientAmount, Recipe,
+                            RecipeTag, ShoppingCart, Tag)
+from recipes.versions import bump_version
+from users.models import Subscribe, User
+
+TAGS = (
+    ('завтрак', '#E26C2D', 'breakfast'),
+    ('обед', '#49B64E', 'lunch'),
+    ('ужин', '#8775D2', 'dinner'),
+    ('десерт', '#D2B48C', 'dessert'),
+    ('перекус', '#FFD700', 'snack'),
+)
+WORDS = ('суп', 'салат', 'пирог', 'рагу', 'омлет', 'паста', 'каша',
+         'запеканка', 'котлеты', 'блины', 'плов', 'борщ')
+ADJECTIVES = ('домашний', 'быстрый', 'летний', 'острый', 'сытный',
+              'бабушкин', 'постный', 'праздничный')
+
+
+def zipf_weights(count, exponent=1.1):
+    """Веса с длинным хвостом: немногие популярные авторы и рецепты
+    получают большую часть подписок, избранного и корзин."""
+    return list(accumulate(1 / rank ** exponent
+                           for rank in range(1, count + 1)))
+
+
+class Command(BaseCommand):
+    help = ('создаёт синтетических пользователей, рецепты, избранное, '
+            'корзины и подписки с неравномерным распределением')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--recipes', type=int, default=1000)
+        parser.add_argument(
+            '--favorites', type=int, default=20,
+            help='среднее число рецептов в избранном у пользователя')
+        parser.add_argument(
+            '--cart', type=int, default=5,
+            help='среднее число рецептов в корзине у пользователя')
+        parser.add_argument(
+            '--subscriptions', type=int, default=10,
+            help='среднее число подписок у пользователя')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def placeholder_image(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (1200, 800), '#E26C2D').save(buffer, 'JPEG')
+        recipe = Recipe()
+        recipe.image.save('seed.jpg', ContentFile(buffer.getvalue()),
+                          save=False)
+        generate_derivatives(recipe.image)
+        return recipe.image.name
+
+    def create_users(self, count, rnd, batch_size):
+        start = (User.objects.order_by('-pk').values_list(
+            'pk', flat=True).first() or 0) + 1
+        password = make_password('seed-password')
+        users = [
+            User(username=f'seed{number}', email=f'seed{number}@example.com',
+                 first_name=rnd.choice(('Анна', 'Иван', 'Мария', 'Олег')),
+                 last_name=f'Тестов{number}', password=password)
+            for number in range(start, start + count)
+        ]
+        User.objects.bulk_create(users, batch_size=batch_size)
+        return list(User.objects.filter(
+            username__in=[user.username for user in users]
+        ).values_list('pk', flat=True))
+
+    def create_recipes(self, count, authors, rnd, batch_size):
+        image = self.placeholder_image()
+        weights = zipf_weights(len(authors))
+        recipes = [
+            Recipe(author_id=rnd.choices(authors, cum_weights=weights)[0],
+                   name=f'{rnd.choice(ADJECTIVES)} {rnd.choice(WORDS)}',
+                   text='синтетический рецепт', image=image,
+                   cooking_time=rnd.randint(5, 180))
+            for _ in range(count)
+        ]
+        created = Recipe.objects.bulk_create(recipes, batch_size=batch_size)
+        if created and created[0].pk is None:
+            return list(Recipe.objects.order_by('-pk').values_list(
+                'pk', flat=True)[:count])
+        return [recipe.pk for recipe in created]
+
+    def create_links(self, recipes, rnd, batch_size):
+        ingredients = list(Ingredient.objects.values_list('pk', flat=True))
+        tags = list(Tag.objects.values_list('pk', flat=True))
+        total = 0
+        for start in range(0, len(recipes), batch_size):
+            amounts, recipe_tags = [], []
+            for recipe in recipes[start:start + batch_size]:
+                amounts += [
+                    IngredientAmount(
+                        recipe_id=recipe, ingredient_id=ingredient,
+                        amount=rnd.randint(1, 500))
+                    for ingredient in rnd.sample(
+                        ingredients,
+                        min(len(ingredients), rnd.randint(3, 12)))
+                ]
+                recipe_tags += [
+                    RecipeTag(recipe_id=recipe, tag_id=tag)
+                    for tag in rnd.sample(
+                        tags, min(len(tags), rnd.randint(1, 3)))
+                ]
+            IngredientAmount.objects.bulk_create(
+                amounts, batch_size=batch_size)
+            RecipeTag.objects.bulk_create(recipe_tags, batch_size=batch_size)
+            total += len(amounts)
+        return total
+
+    def create_pairs(self, model, field, users, targets, mean, rnd,
+                     batch_size):
+        weights = zipf_weights(len(targets))
+        rows, total = [], 0
+        for user in users:
+            size = min(len(targets), int(rnd.expovariate(1 / mean)))
+            chosen = {rnd.choices(targets, cum_weights=weights)[0]
+                      for _ in range(size)}
+            if model is Subscribe:
+                chosen.discard(user)
+            rows += [model(user_id=user, **{field: target})
+                     for target in chosen]
+            if len(rows) >= batch_size:
+                model.objects.bulk_create(rows, ignore_conflicts=True)
+                total, rows = total + len(rows), []
+        model.objects.bulk_create(rows, ignore_conflicts=True)
+        return total + len(rows)
+
+    def handle(self, *args, **options):
+        if options['users'] < 1:
+            raise CommandError('нужен хотя бы один пользователь')
+        started = time.perf_counter()
+        rnd = random.Random(options['seed'])
+        batch_size = options['batch_size']
+        if not Ingredient.objects.exists():
+            call_command('load_ingredients', stdout=self.stdout)
+        for name, color, slug in TAGS:
+            Tag.objects.get_or_create(
+                slug=slug, defaults={'name': name, 'color': color})
+        with transaction.atomic():
+            users = self.create_users(options['users'], rnd, batch_size)
+            rnd.shuffle(users)
+            recipes = self.create_recipes(
+                options['recipes'], users, rnd, batch_size)
+            rnd.shuffle(recipes)
+            amounts = self.create_links(recipes, rnd, batch_size)
+            favorites = self.create_pairs(
+                Favorite, 'recipe_id', users, recipes,
+                options['favorites'], rnd, batch_size)
+            carts = self.create_pairs(
+                ShoppingCart, 'recipe_id', users, recipes,
+                options['cart'], rnd, batch_size)
+            subscriptions = self.create_pairs(
+                Subscribe, 'author_id', users, users,
+                options['subscriptions'], rnd, batch_size)
+        # bulk_create не вызывает сигналы: счётчики, маски тегов,
+        # сводные корзины и ленты пересчитываются отдельно
+        call_command('reconcile_counters', stdout=io.StringIO())
+        call_command('rebuild_shopping_carts', stdout=io.StringIO())
+        call_command('rebuild_feed', stdout=io.StringIO())
+        bump_version('tags')
+        bump_version('ingredients')
+        self.stdout.write(self.style.SUCCESS(
+            f'пользователей {len(users)}, рецептов {len(recipes)}, '
+            f'ингредиентов в рецептах {amounts}, избранное {favorites}, '
+            f'корзины {carts}, подписки {subscriptions} '
+            f'за {time.perf_counter() - started:.1f} с'
+        ))
@@ -0,0 +1,60 @@
+from django.db import migrations
+
+POSTGRESQL_FORWARD = (
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS recipes_ingredient_name_trgm '
+    'ON recipes_ingredient USING gin (UPPER(name) gin_trgm_ops)',
+)
+POSTGRESQL_BACKWARD = (
+    'DROP INDEX IF EXISTS recipes_ingredient_name_trgm',
+)
+SQLITE_FORWARD = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS recipes_ingredient_fts USING fts5("
+    "name, content='recipes_ingredient', content_rowid='id', "
+    "tokenize='trigram')",
+    'CREATE TRIGGER IF NOT EXISTS recipes_ingredient_fts_insert '
+    'AFTER INSERT ON recipes_ingredient BEGIN '
+    'INSERT INTO recipes_ingredient_fts(rowid, name) '
+    'VALUES (new.id, new.name); END',
+    'CREATE TRIGGER IF NOT EXISTS recipes_ingredient_fts_delete '
+    'AFTER DELETE ON recipes_ingredient BEGIN '
+    "INSERT INTO recipes_ingredient_fts(recipes_ingredient_fts, rowid, name) "
+    "VALUES ('delete', old.id, old.name); END",
+    'CREATE TRIGGER IF NOT EXISTS recipes_ingredient_fts_update '
+    'AFTER UPDATE ON recipes_ingredient BEGIN '
+    "INSERT INTO recipes_ingredient_fts(recipes_ingredient_fts, rowid, name) "
+    "VALUES ('delete', old.id, old.name); "
+    'INSERT INTO recipes_ingredient_fts(rowid, name) '
+    'VALUES (new.id, new.name); END',
+    "INSERT INTO recipes_ingredient_fts(recipes_ingredient_fts) "
+    "VALUES ('rebuild')",
+)
+SQLITE_BACKWARD = (
+    'DROP TRIGGER IF EXISTS recipes_ingredient_fts_insert',
+    'DROP TRIGGER IF EXISTS recipes_ingredient_fts_delete',
+    'DROP TRIGGER IF EXISTS recipes_ingredient_fts_update',
+    'DROP TABLE IF EXISTS recipes_ingredient_fts',
+)
+
+
+def run_for_vendor(statements):
+    def run(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, ()):
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_for_vendor({'postgresql': POSTGRESQL_FORWARD,
+                            'sqlite': SQLITE_FORWARD}),
+            run_for_vendor({'postgresql': POSTGRESQL_BACKWARD,
+                            'sqlite': SQLITE_BACKWARD}),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.15 on 2026-10-18 18:14
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def fill_counters(apps, schema_editor):
+    Recipe = apps.get_model('recipes', 'Recipe')
+    Favorite = apps.get_model('recipes', 'Favorite')
+    ShoppingCart = apps.get_model('recipes', 'ShoppingCart')
+    for model, field in ((Favorite, 'favorites_count'),
+                         (ShoppingCart, 'in_carts_count')):
+        Recipe.objects.update(**{field: Coalesce(models.Subquery(
+            model.objects.filter(recipe=models.OuterRef('pk')).order_by()
+            .values('recipe').annotate(total=models.Count('pk'))
+            .values('total')[:1]
+        ), 0)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0004_recipe_pub_date_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='favorites_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='в избранном'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='in_carts_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='в корзинах'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations, models
+
+
+def merge_duplicate_ingredients(apps, schema_editor):
+    Ingredient = apps.get_model('recipes', 'Ingredient')
+    IngredientAmount = apps.get_model('recipes', 'IngredientAmount')
+    ShoppingCartIngredient = apps.get_model(
+        'recipes', 'ShoppingCartIngredient')
+    groups = Ingredient.objects.values(
+        'name', 'measurement_unit'
+    ).annotate(
+        keep=models.Min('id'), total=models.Count('id')
+    ).filter(total__gt=1).order_by()
+    for group in groups:
+        duplicates = list(Ingredient.objects.filter(
+            name=group['name'], measurement_unit=group['measurement_unit']
+        ).exclude(id=group['keep']).values_list('id', flat=True))
+        IngredientAmount.objects.filter(
+            ingredient_id__in=duplicates).update(ingredient_id=group['keep'])
+        affected = duplicates + [group['keep']]
+        ShoppingCartIngredient.objects.filter(
+            ingredient_id__in=affected).delete()
+        totals = IngredientAmount.objects.filter(
+            ingredient_id=group['keep'],
+            recipe__shopping_cart__isnull=False
+        ).values('recipe__shopping_cart__user_id').annotate(
+            total=models.Sum('amount')).order_by()
+        ShoppingCartIngredient.objects.bulk_create(
+            ShoppingCartIngredient(
+                user_id=row['recipe__shopping_cart__user_id'],
+                ingredient_id=group['keep'],
+                amount=row['total'],
+            ) for row in totals
+        )
+        Ingredient.objects.filter(id__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0006_recipe_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            merge_duplicate_ingredients, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.15 on 2026-10-18 18:16
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+ingredient_search = import_module(
+    'recipes.migrations.0002_ingredient_search_index')
+
+
+def restore_fts_triggers(apps, schema_editor):
+    """SQLite добавляет ограничение, пересоздавая таблицу, и триггеры
+    FTS5 из 0002 пропадают вместе со старой таблицей."""
+    if schema_editor.connection.vendor == 'sqlite':
+        for statement in ingredient_search.SQLITE_FORWARD:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0007_merge_duplicate_ingredients'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, restore_fts_triggers),
+        migrations.AddConstraint(
+            model_name='ingredient',
+            constraint=models.UniqueConstraint(fields=('name', 'measurement_unit'), name='unique_ingredient'),
+        ),
+        migrations.RunPython(restore_fts_triggers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.15 on 2026-10-18 18:22
+
+from django.db import migrations
+import recipes.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0008_unique_ingredient'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recipe',
+            name='image',
+            field=recipes.storage.ContentAddressedImageField(db_index=True, upload_to='recipes/images/', verbose_name='изображение'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+from importlib import import_module
+
+from django.db import migrations, models
+
+MAX_TAGS = 63
+recipe_search = import_module('recipes.migrations.0010_recipe_search')
+
+
+def fill_masks(apps, schema_editor):
+    Tag = apps.get_model('recipes', 'Tag')
+    Recipe = apps.get_model('recipes', 'Recipe')
+    RecipeTag = apps.get_model('recipes', 'RecipeTag')
+    tags = list(Tag.objects.order_by('pk'))
+    if len(tags) > MAX_TAGS:
+        raise RuntimeError(f'тегов больше {MAX_TAGS}, маска не поместится')
+    for bit, tag in enumerate(tags):
+        tag.bit = bit
+    Tag.objects.bulk_update(tags, ['bit'])
+    masks = {}
+    for recipe_id, bit in RecipeTag.objects.values_list(
+            'recipe_id', 'tag__bit').distinct():
+        masks[recipe_id] = masks.get(recipe_id, 0) | 1 << bit
+    Recipe.objects.bulk_update(
+        [Recipe(pk=pk, tags_mask=mask) for pk, mask in masks.items()],
+        ['tags_mask'], batch_size=1000)
+
+
+def restore_fts_triggers(apps, schema_editor):
+    """SQLite добавляет и удаляет столбцы, пересоздавая таблицу, и
+    триггеры FTS5 из 0010 пропадают вместе со старой таблицей."""
+    if schema_editor.connection.vendor == 'sqlite':
+        for statement in recipe_search.SQLITE_FORWARD:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0010_recipe_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, restore_fts_triggers),
+        migrations.AddField(
+            model_name='tag',
+            name='bit',
+            field=models.PositiveSmallIntegerField(
+                editable=False, null=True, unique=True,
+                verbose_name='номер бита'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='tags_mask',
+            field=models.BigIntegerField(
+                default=0, editable=False,
+                verbose_name='битовая маска тегов'),
+        ),
+        migrations.RunPython(fill_masks, migrations.RunPython.noop),
+        migrations.RunPython(restore_fts_triggers, migrations.RunPython.noop),
+    ]
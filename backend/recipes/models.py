@@ -1,5 +1,22 @@
-from django.db import models
-from users.models import User
+from collections import Counter
+from itertools import islice
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db import connection, models, transaction
+from django.db.models import (Exists, F, OuterRef, Prefetch, Subquery,
+                              Sum, Value)
+from users.models import CountersMixin, Subscribe, User
+
+from .storage import ContentAddressedImageField
+
+# маска хранится в знаковом BigIntegerField, старший бит не используется
+MAX_TAGS = 63
+
+
+def tags_mask(bits):
+    """Битовая маска по номерам битов тегов."""
+    return sum(1 << bit for bit in set(bits))
 
 
 class Tag(models.Model):
@@ -19,6 +36,12 @@ class Tag(models.Model):
         unique=True,
         verbose_name='уникальный адрес тэга'
     )
+    bit = models.PositiveSmallIntegerField(
+        'номер бита',
+        unique=True,
+        null=True,
+        editable=False
+    )
 
     class Meta:
         verbose_name = 'тег'
@@ -42,12 +65,113 @@ class Ingredient(models.Model):
         verbose_name = 'ингридиент'
         verbose_name_plural = 'ингридиенты'
         ordering = ['name']
+        constraints = [models.UniqueConstraint(
+            fields=['name', 'measurement_unit'],
+            name='unique_ingredient'
+        )]
 
     def __str__(self):
         return f'{self.name}, {self.measurement_unit}'
 
 
-class Recipe(models.Model):
+SEARCH_CONFIG = 'russian'
+
+
+class RecipeQuerySet(models.QuerySet):
+    def with_user_flags(self, user):
+        """Аннотирует флаги избранного, корзины и подписки на автора."""
+        if not user or user.is_anonymous:
+            return self.annotate(
+                is_favorited=Value(False),
+                is_in_shopping_cart=Value(False),
+            )
+        return self.annotate(
+            is_favorited=Exists(Favorite.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+            is_in_shopping_cart=Exists(ShoppingCart.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+        )
+
+    def with_version(self, user):
+        """Аннотирует всё, от чего зависит представление рецепта
+        для пользователя, без загрузки самих данных."""
+        queryset = self.with_user_flags(user)
+        if not user or user.is_anonymous:
+            return queryset.annotate(author_is_subscribed=Value(False))
+        return queryset.annotate(author_is_subscribed=Exists(
+            Subscribe.objects.filter(user=user, author=OuterRef('author'))))
+
+    def with_related(self, user):
+        """Подгружает автора, теги и ингредиенты фиксированным числом
+        запросов вместо отдельных запросов на каждый рецепт."""
+        if not user or user.is_anonymous:
+            authors = User.objects.annotate(is_subscribed=Value(False))
+        else:
+            authors = User.objects.annotate(is_subscribed=Exists(
+                Subscribe.objects.filter(user=user, author=OuterRef('pk'))))
+        return self.prefetch_related(
+            Prefetch('author', queryset=authors),
+            'tags',
+            Prefetch(
+                'ingredientamount_set',
+                queryset=IngredientAmount.objects.select_related(
+                    'ingredient')
+            ),
+        )
+
+    def with_any_tag(self, mask):
+        """Рецепты, у которых есть хотя бы один тег из маски."""
+        return self.alias(
+            tags_matched=F('tags_mask').bitand(mask)
+        ).filter(tags_matched__gt=0)
+
+    def update_tags_mask(self, batch_size=1000, dry_run=False):
+        """Пересчитывает маски тегов по RecipeTag и возвращает число
+        рецептов, у которых маска расходилась."""
+        fixed = 0
+        last_pk = 0
+        while True:
+            batch = dict(self.filter(pk__gt=last_pk).order_by(
+                'pk').values_list('pk', 'tags_mask')[:batch_size])
+            if not batch:
+                return fixed
+            last_pk = max(batch)
+            bits = {pk: [] for pk in batch}
+            for recipe_id, bit in RecipeTag.objects.filter(
+                    recipe_id__in=batch).values_list('recipe_id', 'tag__bit'):
+                bits[recipe_id].append(bit)
+            drifted = [
+                self.model(pk=pk, tags_mask=tags_mask(recipe_bits))
+                for pk, recipe_bits in bits.items()
+                if batch[pk] != tags_mask(recipe_bits)
+            ]
+            fixed += len(drifted)
+            if drifted and not dry_run:
+                self.model.objects.bulk_update(drifted, ['tags_mask'])
+
+    def update_search_vector(self):
+        """Пересчитывает tsvector для PostgreSQL; в SQLite индекс FTS5
+        обновляется триггерами."""
+        if connection.vendor != 'postgresql':
+            return
+        self.update(search_vector=(
+            SearchVector('name', weight='A', config=SEARCH_CONFIG)
+            + SearchVector('text', weight='B', config=SEARCH_CONFIG)
+        ))
+
+    def first_per_author(self, limit):
+        """Оставляет не более limit последних рецептов каждого автора
+        одним запросом."""
+        return self.filter(pk__in=Subquery(
+            self.model.objects.filter(
+                author=OuterRef('author')
+            ).values('pk')[:limit]
+        ))
+
+
+class Recipe(CountersMixin, models.Model):
+    counter_fields = ('favorites_count', 'in_carts_count')
+
     name = models.CharField(
         max_length=100,
         verbose_name='название рецепта'
@@ -58,9 +182,10 @@ class Recipe(models.Model):
         related_name='recipes',
         verbose_name='автор публикации'
     )
-    image = models.ImageField(
+    image = ContentAddressedImageField(
         upload_to='recipes/images/',
         verbose_name='изображение',
+        db_index=True,
     )
     text = models.TextField(
         verbose_name='текстовое описание',
@@ -84,11 +209,43 @@ class Recipe(models.Model):
         verbose_name='дата публикации',
         auto_now_add=True
     )
+    updated_at = models.DateTimeField(
+        verbose_name='дата изменения',
+        auto_now=True
+    )
+    favorites_count = models.PositiveIntegerField(
+        'в избранном',
+        default=0,
+        editable=False
+    )
+    in_carts_count = models.PositiveIntegerField(
+        'в корзинах',
+        default=0,
+        editable=False
+    )
+    tags_mask = models.BigIntegerField(
+        'битовая маска тегов',
+        default=0,
+        editable=False
+    )
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = RecipeQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'рецепт'
         verbose_name_plural = 'рецепты'
         ordering = ['-pub_date']
+        indexes = [
+            models.Index(
+                fields=['-pub_date', '-id'],
+                name='recipe_pub_date_id_idx'
+            ),
+            models.Index(
+                fields=['updated_at'],
+                name='recipe_updated_at_idx'
+            ),
+        ]
 
     def __str__(self):
         return self.name
@@ -182,3 +339,236 @@ class Favorite(models.Model):
             name='unique_favorite'
         )]
         ordering = ['-id']
+
+
+class ShoppingCartIngredientManager(models.Manager):
+    def recipe_amounts(self, recipes):
+        amounts = Counter()
+        if not recipes:
+            return amounts
+        for ingredient_id, amount in IngredientAmount.objects.filter(
+                recipe__in=recipes).values_list('ingredient_id', 'amount'):
+            amounts[ingredient_id] += amount
+        return amounts
+
+    @transaction.atomic(savepoint=False)
+    def apply(self, user_ids, deltas):
+        """Прибавляет deltas {ingredient_id: количество} к сводным
+        корзинам пользователей; строки с нулём удаляются."""
+        deltas = {key: value for key, value in deltas.items() if value}
+        user_ids = list(user_ids)
+        if not deltas or not user_ids:
+            return
+        existing = {
+            (row.user_id, row.ingredient_id): row
+            for row in self.select_for_update().filter(
+                user_id__in=user_ids, ingredient_id__in=deltas)
+        }
+        to_create, to_update, to_delete = [], [], []
+        for user_id in user_ids:
+            for ingredient_id, delta in deltas.items():
+                row = existing.get((user_id, ingredient_id))
+                if row is None:
+                    if delta > 0:
+                        to_create.append(self.model(
+                            user_id=user_id, ingredient_id=ingredient_id,
+                            amount=delta))
+                    continue
+                row.amount += delta
+                if row.amount > 0:
+                    to_update.append(row)
+                else:
+                    to_delete.append(row.pk)
+        self.bulk_create(to_create)
+        self.bulk_update(to_update, ['amount'])
+        if to_delete:
+            self.filter(pk__in=to_delete).delete()
+
+    def change_recipes(self, user_id, added=(), removed=()):
+        """Учитывает в сводной корзине добавленные и убранные рецепты."""
+        deltas = self.recipe_amounts(added)
+        deltas.subtract(self.recipe_amounts(removed))
+        self.apply([user_id], deltas)
+
+    def add_recipe(self, user_id, recipe):
+        self.change_recipes(user_id, added=[recipe])
+
+    def remove_recipe(self, user_id, recipe):
+        self.change_recipes(user_id, removed=[recipe])
+
+    def change_recipe(self, recipe, old_amounts, new_amounts):
+        deltas = Counter(new_amounts)
+        deltas.subtract(old_amounts)
+        self.apply(
+            ShoppingCart.objects.filter(recipe=recipe).values_list(
+                'user_id', flat=True),
+            deltas
+        )
+
+    def live_totals(self, user_ids=None):
+        """Сумма ингредиентов корзин, посчитанная по исходным таблицам."""
+        queryset = IngredientAmount.objects.filter(
+            recipe__shopping_cart__isnull=False)
+        if user_ids is not None:
+            queryset = queryset.filter(
+                recipe__shopping_cart__user_id__in=user_ids)
+        return queryset.values(
+            'recipe__shopping_cart__user_id', 'ingredient_id'
+        ).annotate(total=Sum('amount')).order_by()
+
+
+class ShoppingCartIngredient(models.Model):
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='shopping_cart_ingredients',
+        verbose_name='пользователь'
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name='shopping_cart_ingredients',
+        verbose_name='ингридиент'
+    )
+    amount = models.PositiveIntegerField(
+        verbose_name='кол-во ингридиента'
+    )
+
+    objects = ShoppingCartIngredientManager()
+
+    class Meta:
+        verbose_name = 'ингридиент в корзине'
+        verbose_name_plural = 'ингридиенты в корзине'
+        constraints = [models.UniqueConstraint(
+            fields=['user', 'ingredient'],
+            name='unique_shopping_cart_ingredient'
+        )]
+
+    def __str__(self):
+        return f'{self.ingredient} * {self.amount}'
+
+
+def is_pushed(subscribers_count):
+    """Рецепты автора раскладываются по лентам подписчиков при записи,
+    если подписчиков меньше FEED_FANOUT_LIMIT; иначе лента читает их
+    через подписки."""
+    return subscribers_count < settings.FEED_FANOUT_LIMIT
+
+
+class FeedEntryManager(models.Manager):
+    def subscribers_counts(self, author_ids):
+        return dict(User.objects.filter(pk__in=author_ids).values_list(
+            'pk', 'subscribers_count'))
+
+    def add_entries(self, pairs, recipes, batch_size=1000):
+        """Записи для пар (подписчик, автор) по рецептам
+        {автор: [(id рецепта, дата публикации)]}."""
+        entries = (
+            self.model(user_id=user_id, author_id=author_id,
+                       recipe_id=recipe_id, pub_date=pub_date)
+            for user_id, author_id in pairs
+            for recipe_id, pub_date in recipes.get(author_id, ())
+        )
+        while True:
+            batch = list(islice(entries, batch_size))
+            if not batch:
+                return
+            self.bulk_create(batch, ignore_conflicts=True)
+
+    def author_recipes(self, **filters):
+        recipes = {}
+        for author_id, recipe_id, pub_date in Recipe.objects.filter(
+                **filters).values_list('author_id', 'pk', 'pub_date'):
+            recipes.setdefault(author_id, []).append((recipe_id, pub_date))
+        return recipes
+
+    def fan_out(self, recipe):
+        """Новый рецепт попадает в ленты подписчиков автора."""
+        subscribers = Subscribe.objects.filter(
+            author_id=recipe.author_id,
+            author__subscribers_count__lt=settings.FEED_FANOUT_LIMIT,
+        ).values_list('user_id', flat=True)
+        self.add_entries(
+            ((user_id, recipe.author_id) for user_id in subscribers),
+            {recipe.author_id: [(recipe.pk, recipe.pub_date)]})
+
+    def follow(self, user_id, author_ids):
+        """Вызывается после того, как подписки созданы и счётчики
+        подписчиков авторов обновлены."""
+        counts = self.subscribers_counts(author_ids)
+        # авторы, только что перешедшие на чтение через подписки
+        crossed = [author_id for author_id, count in counts.items()
+                   if count == settings.FEED_FANOUT_LIMIT]
+        pushed = [author_id for author_id, count in counts.items()
+                  if is_pushed(count)]
+        if crossed:
+            self.filter(author_id__in=crossed).delete()
+        if pushed:
+            self.add_entries(
+                [(user_id, author_id) for author_id in pushed],
+                self.author_recipes(author_id__in=pushed))
+
+    def unfollow(self, user_id, author_ids):
+        self.filter(user_id=user_id, author_id__in=author_ids).delete()
+        # авторы, вернувшиеся к раскладке при записи
+        returned = [
+            author_id for author_id, count
+            in self.subscribers_counts(author_ids).items()
+            if count == settings.FEED_FANOUT_LIMIT - 1
+        ]
+        if returned:
+            self.add_entries(
+                Subscribe.objects.filter(
+                    author_id__in=returned).values_list(
+                        'user_id', 'author_id'),
+                self.author_recipes(author_id__in=returned))
+
+    @transaction.atomic
+    def rebuild(self, batch_size=1000):
+        """Пересобирает ленты по подпискам и текущим счётчикам."""
+        self.all().delete()
+        pushed = {
+            'author__subscribers_count__lt': settings.FEED_FANOUT_LIMIT}
+        self.add_entries(
+            Subscribe.objects.filter(**pushed).values_list(
+                'user_id', 'author_id').iterator(),
+            self.author_recipes(**pushed), batch_size)
+        return self.count()
+
+
+class FeedEntry(models.Model):
+    """Рецепт в ленте подписчика; дата публикации продублирована для
+    постраничного чтения по индексу."""
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='feed',
+        verbose_name='подписчик'
+    )
+    author = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='автор'
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='feed_entries',
+        verbose_name='рецепт'
+    )
+    pub_date = models.DateTimeField('дата публикации')
+
+    objects = FeedEntryManager()
+
+    class Meta:
+        verbose_name = 'запись ленты'
+        verbose_name_plural = 'записи ленты'
+        constraints = [models.UniqueConstraint(
+            fields=['user', 'recipe'],
+            name='unique_feed_entry'
+        )]
+        indexes = [models.Index(
+            fields=['user', '-pub_date', '-recipe'],
+            name='feed_user_pub_date_idx'
+        )]
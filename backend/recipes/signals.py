@@ -0,0 +1,186 @@
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import (m2m_changed, post_delete, post_init,
+                                      post_save, pre_delete, pre_save)
+from django.dispatch import receiver
+
+from users.models import User
+
+from .models import (MAX_TAGS, Favorite, FeedEntry, Ingredient, Recipe,
+                     ShoppingCart, ShoppingCartIngredient, Tag)
+from .images import delete_derivatives, generate_derivatives
+from .versions import bump_version
+
+
+def increment(model, pk, field):
+    model.objects.filter(pk=pk).update(**{field: F(field) + 1})
+
+
+def decrement(model, pk, field):
+    model.objects.filter(pk=pk, **{f'{field}__gt': 0}).update(
+        **{field: F(field) - 1})
+
+
+def delete_and_notify(queryset, instance):
+    """Удаляет строку одним DELETE и отправляет сигналы удаления для
+    instance, только если строка действительно была удалена: из двух
+    одновременных запросов счётчики поправит только один.
+    Без точки сохранения: вызывающий код и так в транзакции."""
+    using = queryset.db
+    with transaction.atomic(using=using, savepoint=False):
+        deleted = queryset._raw_delete(using)
+        if deleted:
+            for signal in (pre_delete, post_delete):
+                signal.send(sender=queryset.model, instance=instance,
+                            using=using)
+    return deleted
+
+
+def recount(model, pks, field, source, related):
+    """Пересчитывает счётчик по исходной таблице одним UPDATE."""
+    model.objects.filter(pk__in=pks).update(**{
+        field: Coalesce(Subquery(
+            source.objects.filter(**{related: OuterRef('pk')})
+            .order_by().values(related)
+            .annotate(total=Count('pk')).values('total')[:1]
+        ), 0)
+    })
+
+
+@receiver((post_save, post_delete), sender=Ingredient)
+def ingredients_changed(sender, **kwargs):
+    bump_version('ingredients')
+
+
+@receiver((post_save, post_delete), sender=Tag)
+def tags_changed(sender, **kwargs):
+    bump_version('tags')
+
+
+@receiver(pre_save, sender=Tag)
+def assign_tag_bit(sender, instance, **kwargs):
+    """Новому тегу достаётся наименьший свободный бит маски."""
+    if instance.bit is not None:
+        return
+    used = set(Tag.objects.exclude(bit=None).values_list('bit', flat=True))
+    free = [bit for bit in range(MAX_TAGS) if bit not in used]
+    if not free:
+        raise ValidationError(f'тегов не может быть больше {MAX_TAGS}')
+    instance.bit = free[0]
+
+
+def clear_tag_bit(tag):
+    if tag.bit is not None:
+        Recipe.objects.filter(recipe_tag__tag=tag).update(
+            tags_mask=F('tags_mask').bitand(~(1 << tag.bit)))
+
+
+@receiver(pre_delete, sender=Tag)
+def tag_deleted(sender, instance, **kwargs):
+    # бит освобождается для следующего тега, поэтому его нужно снять
+    # с рецептов до каскадного удаления связей
+    clear_tag_bit(instance)
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def recipe_tags_changed(sender, instance, action, reverse, pk_set,
+                        **kwargs):
+    """recipe.tags.add()/set()/clear() и обратные вызовы у тега.
+    API и админка пишут RecipeTag напрямую и обновляют маску сами."""
+    if reverse and action == 'pre_clear':
+        clear_tag_bit(instance)
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            Recipe.objects.filter(pk=instance.pk).update_tags_mask()
+        elif pk_set:
+            Recipe.objects.filter(pk__in=pk_set).update_tags_mask()
+
+
+@receiver(post_save, sender=ShoppingCart)
+def shopping_cart_added(sender, instance, created, **kwargs):
+    if created:
+        ShoppingCartIngredient.objects.add_recipe(
+            instance.user_id, instance.recipe_id)
+        increment(Recipe, instance.recipe_id, 'in_carts_count')
+
+
+@receiver(pre_delete, sender=ShoppingCart)
+def shopping_cart_removed(sender, instance, **kwargs):
+    ShoppingCartIngredient.objects.remove_recipe(
+        instance.user_id, instance.recipe_id)
+
+
+@receiver(post_delete, sender=ShoppingCart)
+def shopping_cart_deleted(sender, instance, **kwargs):
+    decrement(Recipe, instance.recipe_id, 'in_carts_count')
+
+
+@receiver(post_save, sender=Favorite)
+def favorite_added(sender, instance, created, **kwargs):
+    if created:
+        increment(Recipe, instance.recipe_id, 'favorites_count')
+
+
+@receiver(post_delete, sender=Favorite)
+def favorite_deleted(sender, instance, **kwargs):
+    decrement(Recipe, instance.recipe_id, 'favorites_count')
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_added(sender, instance, created, **kwargs):
+    if created:
+        increment(User, instance.author_id, 'recipes_count')
+        FeedEntry.objects.fan_out(instance)
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_text_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'name', 'text'} & set(update_fields):
+        Recipe.objects.filter(pk=instance.pk).update_search_vector()
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_deleted(sender, instance, **kwargs):
+    decrement(User, instance.author_id, 'recipes_count')
+    bump_version('deleted_recipes')
+
+
+@receiver(post_init, sender=Recipe)
+def remember_image(sender, instance, **kwargs):
+    image = instance.__dict__.get('image')
+    instance._saved_image_name = getattr(image, 'name', image)
+
+
+def release_image(name, storage):
+    """Удаляет файл и его копии, когда на него не ссылается ни один
+    рецепт. Проверка выполняется после фиксации транзакции."""
+    def delete_orphan():
+        # под блокировкой хранилища: иначе рецепт, повторно
+        # использующий файл, может зафиксироваться между проверкой
+        # и удалением
+        with storage.lock():
+            if not Recipe.objects.filter(image=name).exists():
+                storage.delete(name)
+                delete_derivatives(name, storage)
+
+    if name:
+        transaction.on_commit(delete_orphan)
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_image_saved(sender, instance, **kwargs):
+    previous = instance._saved_image_name
+    if instance.image and instance.image.name != previous:
+        # копии создаются после фиксации, чтобы уменьшение изображения
+        # не держало транзакцию открытой
+        image = instance.image
+        transaction.on_commit(lambda: generate_derivatives(image))
+        release_image(previous, instance.image.storage)
+    instance._saved_image_name = instance.image.name
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_image_deleted(sender, instance, **kwargs):
+    release_image(instance.image.name, instance.image.storage)
@@ -0,0 +1,109 @@
+import hashlib
+import os
+import posixpath
+from contextlib import contextmanager
+
+from django.core.files import locks
+from django.core.files.storage import FileSystemStorage
+from django.db import models, transaction
+from django.db.models.fields.files import ImageFieldFile
+from django.utils.crypto import get_random_string
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """Хранилище, в котором имя файла определяется его содержимым.
+
+    Одинаковые файлы получают одно имя и хранятся один раз, поэтому
+    существующий файл никогда не переименовывается и не перезаписывается.
+    """
+    lock_name = '.lock'
+
+    def content_name(self, name, content):
+        directory, filename = posixpath.split(name)
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        digest = digest.hexdigest()
+        extension = os.path.splitext(filename)[1].lower()
+        return posixpath.join(
+            directory, digest[:2], digest[2:4], digest + extension)
+
+    def is_content_name(self, name):
+        stem = os.path.splitext(posixpath.basename(name))[0]
+        parts = posixpath.dirname(name).split('/')
+        return (len(stem) == 64 and parts[-2:] == [stem[:2], stem[2:4]]
+                and all(char in '0123456789abcdef' for char in stem))
+
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def _save(self, name, content):
+        if self.exists(name):
+            return name
+        temporary = super()._save(
+            f'{name}.{get_random_string(8)}.tmp', content)
+        os.replace(self.path(temporary), self.path(name))
+        return name
+
+    @contextmanager
+    def lock(self):
+        """Блокировка между процессами: удаление файла без ссылок
+        и восстановление файла после фиксации не пересекаются."""
+        os.makedirs(self.location, exist_ok=True)
+        with open(self.path(self.lock_name), 'ab') as file:
+            locks.lock(file, locks.LOCK_EX)
+            try:
+                yield
+            finally:
+                locks.unlock(file)
+
+    def restore(self, name, content):
+        """Записывает файл заново, если его удалили как файл без ссылок,
+        пока рецепт, использующий его повторно, ещё не был зафиксирован."""
+        with self.lock():
+            if not self.exists(name):
+                self._save(name, content)
+
+
+class ContentAddressedFieldFile(ImageFieldFile):
+    def save(self, name, content, save=True):
+        name = self.storage.content_name(
+            self.field.generate_filename(self.instance, name), content)
+        reused = self.storage.exists(name)
+        self.name = self.storage.save(
+            name, content, max_length=self.field.max_length)
+        if reused:
+            # до фиксации другой запрос может удалить файл, решив, что
+            # на него больше никто не ссылается
+            transaction.on_commit(
+                lambda: self.storage.restore(name, content))
+        elif hasattr(content, 'temporary_file_path'):
+            # временный файл загрузки уже перемещён в хранилище
+            content.close()
+        setattr(self.instance, self.field.attname, self.name)
+        self._committed = True
+        if save:
+            self.instance.save()
+
+    save.alters_data = True
+
+
+class ContentAddressedImageField(models.ImageField):
+    attr_class = ContentAddressedFieldFile
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('storage', recipe_image_storage)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if kwargs.get('storage') is recipe_image_storage:
+            del kwargs['storage']
+        return name, path, args, kwargs
+
+
+recipe_image_storage = ContentAddressedStorage()
@@ -0,0 +1,49 @@
+import time
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache
+
+VERSION_KEY = 'recipes:version:{}'
+LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def get_version(name):
+    """Возвращает метку версии набора данных (время последнего изменения).
+
+    Метка хранится в кэше Django, поэтому при общем бэкенде кэша
+    она согласована между всеми воркерами.
+    """
+    key = VERSION_KEY.format(name)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(name):
+    cache.set(VERSION_KEY.format(name), time.time(), timeout=None)
+
+
+def versions_are_shared():
+    """Метки видны всем процессам: кэш общий или процесс один."""
+    backend = settings.CACHES[DEFAULT_CACHE_ALIAS]['BACKEND']
+    return settings.SINGLE_PROCESS or backend not in LOCAL_CACHE_BACKENDS
+
+
+@checks.register(checks.Tags.caches)
+def check_versions_are_shared(app_configs, **kwargs):
+    if versions_are_shared():
+        return []
+    return [checks.Warning(
+        'метки версий хранятся в локальном кэше процесса',
+        hint=('при нескольких воркерах задайте общий CACHE_BACKEND '
+              '(Redis, Memcached), иначе изменения справочников не видны '
+              'в других процессах; для одного процесса укажите '
+              'SINGLE_PROCESS=True. Кэш токенов до этого отключён.'),
+        id='recipes.W001',
+    )]
@@ -0,0 +1,39 @@
+# Generated by Django 3.2.15 on 2026-10-18 18:14
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def fill_counters(apps, schema_editor):
+    User = apps.get_model('users', 'User')
+    Subscribe = apps.get_model('users', 'Subscribe')
+    Recipe = apps.get_model('recipes', 'Recipe')
+    for model, field in ((Recipe, 'recipes_count'),
+                         (Subscribe, 'subscribers_count')):
+        User.objects.update(**{field: Coalesce(models.Subquery(
+            model.objects.filter(author=models.OuterRef('pk')).order_by()
+            .values('author').annotate(total=models.Count('pk'))
+            .values('total')[:1]
+        ), 0)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+        ('recipes', '0005_recipe_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='recipes_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Рецептов'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='subscribers_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Подписчиков'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
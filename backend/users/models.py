@@ -2,7 +2,24 @@ from django.contrib.auth.models import AbstractUser
 from django.db import models
 
 
-class User(AbstractUser):
+class CountersMixin:
+    """Счётчики меняются только через F()-выражения, поэтому обычное
+    сохранение объекта не перезаписывает их устаревшими значениями."""
+    counter_fields = ()
+
+    def save(self, *args, **kwargs):
+        if (not self._state.adding and not args
+                and kwargs.get('update_fields') is None
+                and not kwargs.get('force_insert')):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.counter_fields
+            ]
+        super().save(*args, **kwargs)
+
+
+class User(CountersMixin, AbstractUser):
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ('username', 'first_name', 'last_name',)
     USER = 'user'
@@ -12,6 +29,7 @@ class User(AbstractUser):
         (USER, 'Пользователь'),
         (ADMIN, 'Администратор'),
     )
+    counter_fields = ('recipes_count', 'subscribers_count')
 
     username = models.TextField(
         'Пользователь',
@@ -37,6 +55,16 @@ class User(AbstractUser):
         unique=True,
         max_length=254
     )
+    recipes_count = models.PositiveIntegerField(
+        'Рецептов',
+        default=0,
+        editable=False
+    )
+    subscribers_count = models.PositiveIntegerField(
+        'Подписчиков',
+        default=0,
+        editable=False
+    )
 
     @property
     def is_admin(self):
@@ -0,0 +1,20 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from recipes.models import FeedEntry
+from recipes.signals import decrement, increment
+
+from .models import Subscribe, User
+
+
+@receiver(post_save, sender=Subscribe)
+def subscribe_added(sender, instance, created, **kwargs):
+    if created:
+        increment(User, instance.author_id, 'subscribers_count')
+        FeedEntry.objects.follow(instance.user_id, [instance.author_id])
+
+
+@receiver(post_delete, sender=Subscribe)
+def subscribe_deleted(sender, instance, **kwargs):
+    decrement(User, instance.author_id, 'subscribers_count')
+    FeedEntry.objects.unfollow(instance.user_id, [instance.author_id])